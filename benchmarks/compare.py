@@ -0,0 +1,35 @@
+"""Compares timings of two benchmark result files."""
+import json
+
+import click
+
+
+@click.command()
+@click.argument('base', type=click.File())
+@click.argument('current', type=click.File())
+@click.option('--threshold', default=1.1, show_default=True, help="Slowdown ratio reported as a regression.")
+@click.option('--stat', default='min', show_default=True, type=click.Choice(['min', 'median', 'mean']))
+def main(base, current, threshold, stat):
+    base_report = json.load(base)
+    current_report = json.load(current)
+    base_results = base_report['results']
+    current_results = current_report['results']
+
+    click.echo("%s -> %s" % (base_report['meta']['commit'], current_report['meta']['commit']))
+    regressions = 0
+    for name in sorted(set(base_results) & set(current_results)):
+        before = base_results[name][stat]
+        after = current_results[name][stat]
+        ratio = after / before if before else float('inf')
+        marker = ''
+        if ratio > threshold:
+            marker = '  REGRESSION'
+            regressions += 1
+        click.echo("%-32s %10.3f ms %10.3f ms %6.2fx%s" % (name, before * 1000, after * 1000, ratio, marker))
+
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""In-memory stand-in for the subset of Motor used by talkbot."""
+import itertools
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+
+INDEX_OPTIONS_CONFLICT = 85
+
+
+def matches(document, query):
+    for key, condition in query.items():
+        value = document.get(key)
+        if isinstance(condition, dict):
+            if '$in' in condition and value not in condition['$in']:
+                return False
+            if '$gt' in condition and not (value is not None and value > condition['$gt']):
+                return False
+            if '$exists' in condition and (key in document) != condition['$exists']:
+                return False
+            if condition.get('$type') == 'object' and not isinstance(value, dict):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class InsertOneResult:
+
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+
+class BulkWriteResult:
+
+    def __init__(self, modified_count):
+        self.modified_count = modified_count
+
+
+class DeleteResult:
+
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+
+
+class MemoryCursor:
+
+    def __init__(self, documents):
+        self.documents = documents
+        self._skip = 0
+        self._limit = 0
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def sort(self, key, direction):
+        self.documents = sorted(self.documents, key=lambda document: document[key], reverse=direction < 0)
+        return self
+
+    def _selected(self):
+        stop = self._skip + self._limit if self._limit else None
+        return itertools.islice(self.documents, self._skip, stop)
+
+    async def to_list(self, length):
+        return list(itertools.islice(self._selected(), length))
+
+    def __aiter__(self):
+        self._iterator = self._selected()
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class MemoryCollection:
+    """Documents kept in insertion order with lazily built equality indexes.
+
+    An index is built for the first scalar field of a query, so lookups by
+    `chat_id` and the like do not scan the whole collection as Mongo
+    wouldn't either.
+    """
+
+    def __init__(self):
+        self.documents = []
+        self.by_id = {}
+        self.field_indexes = {}
+        self.bulk_requests = []
+        self.indexes = {}
+
+    def _index(self, field):
+        index = self.field_indexes.get(field)
+        if index is None:
+            index = self.field_indexes[field] = {}
+            for document in self.documents:
+                index.setdefault(document.get(field), []).append(document)
+        return index
+
+    def _select(self, query):
+        query = query or {}
+        scalar = [key for key, condition in query.items() if not isinstance(condition, dict)]
+        if '_id' in scalar:
+            document = self.by_id.get(query['_id'])
+            candidates = [document] if document else []
+        elif scalar:
+            candidates = self._index(scalar[0]).get(query[scalar[0]], [])
+        else:
+            candidates = self.documents
+        return [document for document in candidates if matches(document, query)]
+
+    def insert_many_documents(self, documents):
+        for document in documents:
+            document.setdefault('_id', ObjectId())
+            self.documents.append(document)
+            self.by_id[document['_id']] = document
+            for field, index in self.field_indexes.items():
+                index.setdefault(document.get(field), []).append(document)
+
+    def find(self, query=None, projection=None):
+        return MemoryCursor(self._select(query))
+
+    async def find_one(self, query=None):
+        found = self._select(query)
+        return found[0] if found else None
+
+    async def count(self, query=None):
+        return len(self._select(query))
+
+    async def insert_one(self, document):
+        document = dict(document)
+        self.insert_many_documents([document])
+        return InsertOneResult(document['_id'])
+
+    async def update_one(self, query, update, upsert=False):
+        found = self._select(query)[:1]
+        if not found and upsert:
+            document = dict((key, value) for key, value in query.items() if not isinstance(value, dict))
+            document.update(update.get('$setOnInsert', {}))
+            document.update(update.get('$set', {}))
+            self.insert_many_documents([document])
+        for document in found:
+            document.update(update.get('$set', {}))
+
+    async def bulk_write(self, requests, ordered=True):
+        """Records `requests` without applying them, pymongo keeps their contents private."""
+        self.bulk_requests.extend(requests)
+        return BulkWriteResult(len(requests))
+
+    async def delete_many(self, query):
+        stale = set(id(document) for document in self._select(query))
+        self.documents = [document for document in self.documents if id(document) not in stale]
+        self.by_id = dict((document['_id'], document) for document in self.documents)
+        self.field_indexes = {}
+        return DeleteResult(len(stale))
+
+    async def distinct(self, key):
+        return sorted(set(document[key] for document in self.documents if key in document))
+
+    async def create_indexes(self, indexes):
+        for index in indexes:
+            existing = self.indexes.get(index.document['name'])
+            if existing is not None and existing != index.document:
+                raise OperationFailure("Index with name: %s already exists with different options"
+                                       % index.document['name'], code=INDEX_OPTIONS_CONFLICT)
+        for index in indexes:
+            self.indexes[index.document['name']] = dict(index.document)
+        return [index.document['name'] for index in indexes]
+
+    async def index_information(self):
+        return dict((name, dict(index)) for name, index in self.indexes.items())
+
+    async def drop_index(self, name):
+        del self.indexes[name]
+
+
+class MemoryDatabase(dict):
+    """Collections created on first access, database commands are recorded in `commands`."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commands = []
+
+    async def command(self, name, value, **options):
+        self.commands.append((name, value, options))
+
+    def __missing__(self, name):
+        collection = self[name] = MemoryCollection()
+        return collection
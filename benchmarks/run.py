@@ -0,0 +1,258 @@
+"""Offline microbenchmarks of the message processing hot paths.
+
+Storage is replaced with an in-memory stand-in for Motor and images,
+reactions and fingerprints are synthetic, so no network or Mongo is needed:
+
+    python -m benchmarks.run --out results.json
+    python -m benchmarks.compare base.json results.json
+"""
+import asyncio
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+
+import click
+import inject
+import numpy
+
+from PIL import Image
+from bson import Binary
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from sklearn.ensemble import GradientBoostingClassifier
+
+from talkbot.entities import Config, Reaction, ImageFinger, FileFingerprint
+from talkbot.fingerprinting import FingerprintCache, FingerprintService, fingerprint
+from talkbot.hamming import FingerprintIndex
+from talkbot.loadtest import make_photo
+from talkbot.matcher import ReactionMatcher
+from talkbot.reactor import MessageReactor
+from talkbot.usage import UsageLedger
+from talkbot.utils import calc_scores, prepare_image, get_diff_vector, DuplicateCascade, FEATURES
+
+from .memory_db import MemoryCollection, MemoryDatabase
+
+
+IMAGE_SIZES = (320, 800, 1280)
+REACTION_COUNTS = (10, 1000, 100000)
+FINGERPRINT_COUNTS = (100, 10000, 100000)
+# stored variants of the checked photo, each a few bits off
+NEAR_DUPLICATES = 4
+MIN_RUN_TIME = 0.05
+
+
+def measure(func, repeat=5):
+    """Runs `func` in `repeat` rounds of at least MIN_RUN_TIME, returns per call timings."""
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= MIN_RUN_TIME:
+            break
+        number *= 2
+
+    timings = [elapsed / number]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - started) / number)
+
+    return {
+        'number': number,
+        'repeat': repeat,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings),
+        'max': max(timings),
+    }
+
+
+def make_model(seed=0):
+    random = numpy.random.RandomState(seed)
+    distances = random.randint(0, 128, (2000, len(FEATURES)))
+    labels = distances.mean(axis=1) < 48
+    return GradientBoostingClassifier(random_state=seed).fit(distances, labels)
+
+
+def make_reactions(count, seed=0):
+    random = numpy.random.RandomState(seed)
+    letters = numpy.array(list('abcdefghijklmnopqrstuvwxyz'))
+    reactions = []
+    for _ in range(count):
+        pattern = ''.join(random.choice(letters, 8))
+        reactions.append({'patterns': [pattern], 'image_url': '', 'image_id': '', 'text': pattern,
+                          'created_at': 0, 'created_by': {'id': 1, 'first_name': "bench"}})
+    return reactions
+
+
+def make_fingerprints(chat_id, count, near=None, seed=0):
+    """Random fingerprints, the last NEAR_DUPLICATES ones are `near` with a few bits flipped."""
+    random = numpy.random.RandomState(seed)
+    vectors = random.randint(0, 256, (count, len(FEATURES), 32)).astype(numpy.uint8)
+    if near is not None:
+        for idx in range(max(count - NEAR_DUPLICATES, 0), count):
+            flips = (random.rand(*near.shape) < 0.01) << random.randint(0, 8, near.shape)
+            vectors[idx] = near ^ flips.astype(numpy.uint8)
+    return [{
+        'version': ImageFinger.VERSION,
+        'vectors': Binary(vectors[idx].tobytes()),
+        'message_id': idx,
+        'file_id': 'file-%d-%d' % (chat_id, idx),
+        'chat_id': chat_id,
+    } for idx in range(count)]
+
+
+class FakeBot:
+
+    def __init__(self, data):
+        self.data = data
+
+    async def get_file(self, file_id):
+        return {'file_id': file_id, 'file_path': 'photos/%s.jpg' % file_id}
+
+    async def download_file(self, path):
+        return self.data
+
+    def send_message(self, payload):
+        pass
+
+    def send_photo(self, payload):
+        pass
+
+
+def configure(loop):
+    here = os.path.abspath(__file__)
+    config = Config.load_config({'sslchain': here, 'sslprivkey': here, 'sample_df': here, 'fingerprints_per_chat': 0})
+    db = MemoryDatabase()
+    fingerprints = FingerprintIndex(ImageFinger, FEATURES, config.repetition_radius, budget=config.fingerprint_memory)
+    fingerprinter = FingerprintService(1, 0, loop=loop)
+    fingerprinter.start()
+
+    def config_injections(binder):
+        binder.bind(Config, config)
+        binder.bind(AsyncIOMotorDatabase, db)
+        binder.bind(GradientBoostingClassifier, make_model())
+        # every candidate goes through the classifier
+        binder.bind(DuplicateCascade, DuplicateCascade.DISABLED)
+        binder.bind(ReactionMatcher, ReactionMatcher(loop=loop))
+        binder.bind(UsageLedger, UsageLedger(Reaction.collection))
+        binder.bind(FingerprintIndex, fingerprints)
+        binder.bind(FingerprintService, fingerprinter)
+        binder.bind(FingerprintCache, FingerprintCache(FileFingerprint, FEATURES, config.fingerprint_cache_size))
+
+    inject.clear_and_configure(config_injections)
+    return db, fingerprints, fingerprinter
+
+
+def bench_images(results):
+    for size in IMAGE_SIZES:
+        data = make_photo(size, size * 3 // 4)
+        results['calc_scores[%d]' % size] = measure(lambda: calc_scores(Image.open(io.BytesIO(data))))
+        results['prepare_image[%d]' % size] = measure(lambda: prepare_image(Image.open(io.BytesIO(data))))
+
+    first = dict(calc_scores(Image.open(io.BytesIO(make_photo(800, 600, seed=1)))))
+    second = dict(calc_scores(Image.open(io.BytesIO(make_photo(800, 600, seed=2)))))
+    results['get_diff_vector'] = measure(lambda: get_diff_vector(first, second))
+
+
+def bench_reactions(results, loop, db, counts):
+    matcher = inject.instance(ReactionMatcher)
+    bot = FakeBot(b'')
+    for count in counts:
+        reactions = make_reactions(count)
+        db[Reaction.collection] = MemoryCollection()
+        db[Reaction.collection].insert_many_documents(reactions)
+        loop.run_until_complete(matcher.reload(db))
+        # the periodic refresh with nothing changed
+        results['load_reactions[%d]' % count] = measure(lambda: loop.run_until_complete(matcher.load(db=db)))
+
+        # a hit in the middle of an ordinary chat message
+        text = "Lorem ipsum dolor sit amet %s consectetur adipiscing elit" % reactions[count // 2]['patterns'][0]
+        message = {'message_id': 1, 'chat': {'id': 1}, 'text': text, 'date': int(time.time())}
+
+        def search():
+            loop.run_until_complete(MessageReactor(message, bot).search_reactions(message))
+        results['search_reactions[%d]' % count] = measure(search)
+
+
+def bench_repetitions(results, loop, db, fingerprints, counts):
+    """Checks of a photo with near-duplicates stored, so candidates go through the classifier.
+
+    The photo is answered as a repost and nothing is stored, the chat keeps
+    its size while measured.
+    """
+    data = make_photo(800, 600)
+    bot = FakeBot(data)
+    near = fingerprint(data)
+    message_ids = iter(range(10 ** 9))
+    for chat_id, count in enumerate(counts, 1):
+        documents = make_fingerprints(chat_id, count, near=near, seed=chat_id)
+        db[ImageFinger.collection].insert_many_documents(documents)
+
+        # the first lookup of a chat loads and indexes it
+        def load():
+            fingerprints.discard(chat_id)
+            loop.run_until_complete(fingerprints.get(chat_id))
+        results['fingerprints_load[%d]' % count] = measure(load, repeat=1)
+
+        def check():
+            message_id = next(message_ids)
+            message = {
+                'message_id': message_id,
+                'chat': {'id': chat_id},
+                'date': int(time.time()),
+                'photo': [{'file_id': 'new-%d' % message_id, 'width': 800, 'height': 600}],
+            }
+            loop.run_until_complete(MessageReactor(message, bot).check_repetitions(message))
+        results['check_repetitions[%d]' % count] = measure(check)
+        assert len(fingerprints.chats[chat_id]) == count, "checked photos were stored"
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option('--out', '-o', default="benchmarks.json", type=click.Path(dir_okay=False))
+@click.option('--quick', is_flag=True, help="Skip the largest reaction and fingerprint sets.")
+def main(out, quick):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    db, fingerprints, fingerprinter = configure(loop)
+    results = {}
+
+    try:
+        bench_images(results)
+        bench_reactions(results, loop, db, REACTION_COUNTS[:-1] if quick else REACTION_COUNTS)
+        bench_repetitions(results, loop, db, fingerprints, FINGERPRINT_COUNTS[:-1] if quick else FINGERPRINT_COUNTS)
+    finally:
+        loop.run_until_complete(fingerprinter.shutdown())
+        loop.close()
+
+    for name, stats in results.items():
+        click.echo("%-32s %10.3f ms" % (name, stats['median'] * 1000))
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'created': int(time.time()),
+        },
+        'results': results,
+    }
+    with open(out, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -44,7 +44,7 @@ setup(
     author='Yehor Nazarkin',
     author_email='nimnull@gmail.com',
     url='https://github.com/nimnull/talkabit/',
-    packages=find_packages(exclude=('tests',)),
+    packages=find_packages(exclude=('tests', 'benchmarks')),
     license='LICENSE.txt',
     platforms=['OS Independent'],
     classifiers=CLASSIFIERS,
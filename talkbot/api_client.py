@@ -1,73 +1,53 @@
-import io
 import time
 
 from datetime import datetime
 from http import HTTPStatus
-from urllib.parse import urljoin
 
 import aiohttp
 
 from talkbot.reactor import MessageReactor
 from .logger import log
+from .outbound import OutboundDispatcher
+from .utils import ApiError
 
 
 class TelegramBot:
-    BASE_URI = "https://api.telegram.org/bot{0.token}/"
-    FILE_URI = "https://api.telegram.org/file/bot{0.token}/"
 
-    def __init__(self, token, session):
+    def __init__(self, api, download_limit=5 * 1024 * 1024, send_rates=(30, 1, 20 / 60), loop=None):
         self.update_offset = 0
         self.username = "ZamzaBot"
-        self.token = token
-        self.session = session
-
-    def _get_uri(self, endpoint):
-        return urljoin(self.BASE_URI.format(self), endpoint)
-
-    def _get_file_path(self, file_path):
-        return urljoin(self.FILE_URI.format(self), file_path)
-
-    async def _raise_for_response(self, response):
-        r_data = await response.json()
-        if r_data['ok']:
-            return r_data['result']
-        else:
-            msg = "{error_code} | {description} ".format(**r_data)
-            log.error(msg)
+        self.api = api
+        self.download_limit = download_limit
+        rate, chat_rate, group_rate = send_rates
+        self.outbound = OutboundDispatcher(self.call, rate=rate, chat_rate=chat_rate, group_rate=group_rate,
+                                           loop=loop)
+
+    async def call(self, method, payload):
+        result = await self.api.call(method, payload)
+        log.info("sent: %s", result)
+        return result
 
-    async def pong(self, chat, sender=None):
+    def pong(self, chat, sender=None):
         name = sender['first_name']
         payload = {
             'chat_id': chat['id'],
             'text': '{} confirmed at {}.'.format(name, datetime.now().isoformat('T'))
         }
-        return await self.send_message(payload)
+        self.send_message(payload)
 
-    async def send_message(self, payload):
+    def send_message(self, payload):
         payload['disable_notification'] = True
+        self.outbound.submit('sendMessage', payload)
 
-        try:
-            resp = await self.session.post(self._get_uri('sendMessage'), data=payload)
-            result = await self._raise_for_response(resp)
-            log.info("sent: %s", result)
-        except aiohttp.ClientResponseError as ex:
-            log.error("Message send failed %s", ex, exc_info=True)
-
-    async def send_photo(self, payload):
+    def send_photo(self, payload):
         payload['disable_notification'] = True
-        try:
-            resp = await self.session.post(self._get_uri('sendPhoto'), data=payload)
-            result = await self._raise_for_response(resp)
-            log.info("sent: %s", result)
-        except aiohttp.ClientResponseError as ex:
-                log.error("Message send failed %s", ex, exc_info=True)
+        self.outbound.submit('sendPhoto', payload)
 
     async def get_file(self, file_id):
         try:
-            resp = await self.session.get(self._get_uri('getFile'), params={'file_id': file_id})
-            result = await self._raise_for_response(resp)
+            result = await self.api.call('getFile', params={'file_id': file_id})
             log.info("File: %s", result)
-        except aiohttp.ClientResponseError as ex:
+        except (aiohttp.ClientResponseError, ApiError) as ex:
             log.error("Failed to retreive file: %s", ex, exc_info=True)
             return None
 
@@ -94,20 +74,26 @@ class TelegramBot:
         payload.update(reactor.response)
 
         if 'photo' in payload:
-            await self.send_photo(payload)
+            self.send_photo(payload)
         elif 'text' in payload:
-            await self.send_message(payload)
+            self.send_message(payload)
 
-    async def set_hook(self):
+    async def set_hook(self, url):
         payload = {
-            'url': "https://talkbot1.mediasapiens.org/updates/"
+            'url': url
         }
-        resp = await self.session.post(self._get_uri('setWebhook'), data=payload)
-        await self._raise_for_response(resp)
+        await self.api.call('setWebhook', payload)
 
-    async def download_file(self, path):
-        resp = await self.session.get(self._get_file_path(path))
-        resp.raise_for_status()
+    async def delete_hook(self):
+        await self.api.call('deleteWebhook', {})
 
-        data = await resp.content.read()
-        return io.BytesIO(data)
+    async def get_updates(self, limit=100, timeout=30):
+        params = {
+            'offset': self.update_offset,
+            'limit': limit,
+            'timeout': timeout,
+        }
+        return await self.api.call('getUpdates', params=params)
+
+    async def download_file(self, path):
+        return await self.api.download(path, self.download_limit)
@@ -1,9 +1,27 @@
 import json
 
+from contextlib import contextmanager
+
 import click
 import trafaret as t
 
-from talkbot.main import init
+from talkbot.entities import ImageFinger
+from talkbot.loadtest import replay_config, run_replay
+from talkbot.main import init, poll, run_command
+from talkbot.storage import ensure_indexes
+from talkbot.utils import FEATURES
+
+
+@contextmanager
+def config_errors(config):
+    try:
+        yield
+    except json.decoder.JSONDecodeError as ex:
+        click.echo("Failed to parse %s. %s" % (config.name, ex), err=True)
+    except t.DataError as ex:
+        for item in ex.as_dict().items():
+            click.echo("Wrong attribute '%s' — '%s'" % item)
+
 
 @click.group()
 def main():
@@ -13,11 +31,76 @@ def main():
 @main.command()
 @click.option('--config', '-c', default="config.json", type=click.File(encoding='utf-8'))
 def run(config):
-    try:
+    with config_errors(config):
         config_struct = json.load(config)
         init(config_struct)
-    except json.decoder.JSONDecodeError as ex:
-        click.echo("Failed to parse %s. %s" % (config.name, ex), err=True)
-    except t.DataError as ex:
-        for item in ex.as_dict().items():
-            click.echo("Wrong attribute '%s' — '%s'" % item)
+
+
+@main.command('poll')
+@click.option('--config', '-c', default="config.json", type=click.File(encoding='utf-8'))
+def poll_updates(config):
+    """Receive updates with getUpdates long polling instead of the webhook."""
+    with config_errors(config):
+        config_struct = json.load(config)
+        poll(config_struct)
+
+
+@main.command('replay')
+@click.option('--config', '-c', default="config.json", type=click.File(encoding='utf-8'))
+@click.option('--input', '-i', 'recording', required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--database', required=True, help="Mongo database to store into, other than the configured one.")
+@click.option('--rate', default=0.0, type=float, help="Updates per second, recorded pace if 0.")
+@click.option('--concurrency', default=10, type=click.IntRange(min=1))
+@click.option('--out', '-o', default=None, type=click.File('w'), help="Write the report as JSON.")
+def replay_updates(config, recording, database, rate, concurrency, out):
+    """Replay recorded updates against a local app and a fake Telegram API."""
+    with config_errors(config):
+        config_struct = json.load(config)
+        try:
+            replay_config(config_struct, database)
+        except ValueError as ex:
+            raise click.BadParameter(str(ex), param_hint='--database')
+        report = run_replay(config_struct, recording, database, rate, concurrency)
+        for item in sorted(report.items()):
+            click.echo("%s: %s" % item)
+        if out is not None:
+            json.dump(report, out, indent=2, sort_keys=True)
+
+
+@main.group()
+def db():
+    pass
+
+
+@db.command('ensure-indexes')
+@click.option('--config', '-c', default="config.json", type=click.File(encoding='utf-8'))
+def db_ensure_indexes(config):
+    """Create indexes declared by the stored entities."""
+    with config_errors(config):
+        config_struct = json.load(config)
+        created = run_command(config_struct, ensure_indexes)
+        click.echo("Ensured %d indexes" % len(created))
+
+
+@db.command('compact')
+@click.option('--config', '-c', default="config.json", type=click.File(encoding='utf-8'))
+@click.option('--batch-size', default=500, type=click.IntRange(min=1))
+def compact(config, batch_size):
+    """Strip stored messages off fingerprints and trim chats over the per-chat cap."""
+    with config_errors(config):
+        config_struct = json.load(config)
+        compacted, trimmed = run_command(config_struct, ImageFinger.compact, batch_size)
+        created = run_command(config_struct, ensure_indexes, [ImageFinger])
+        click.echo("Compacted %d fingerprints, trimmed %d, ensured indexes: %s" % (
+            compacted, trimmed, ", ".join(created)))
+
+
+@db.command('migrate-fingerprints')
+@click.option('--config', '-c', default="config.json", type=click.File(encoding='utf-8'))
+@click.option('--batch-size', default=500, type=click.IntRange(min=1))
+def migrate_fingerprints(config, batch_size):
+    """Rewrite fingerprints stored as lists of booleans into packed binary vectors."""
+    with config_errors(config):
+        config_struct = json.load(config)
+        migrated = run_command(config_struct, ImageFinger.migrate_vectors, FEATURES, batch_size)
+        click.echo("Migrated %d fingerprints" % migrated)
@@ -1,8 +1,11 @@
 import re
 from itertools import chain
 
+import inject
+
 from .entities import Reaction
 from .logger import log
+from .matcher import ReactionMatcher
 from .utils import get_user_repr, url_regex
 
 
@@ -48,7 +51,8 @@ async def add_reaction(reactor, cmd, message):
         }
         return
 
-    await Reaction.create(reaction)
+    created = await Reaction.create(reaction)
+    inject.instance(ReactionMatcher).add(created)
 
     reactor.response = {
         'text': "Saved reaction for `{}` by {}".format(", ".join(patterns), get_user_repr(message['from']))
@@ -1,17 +1,33 @@
+import datetime
 import re
 import time
 from collections import namedtuple
 
 import inject
+import numpy
 import trafaret as t
 
+from bson import Binary
 from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne
+from pymongo.errors import OperationFailure
 from trafaret.contrib.object_id import MongoId
 
+from .hamming import FingerprintIndex, pack_hashes
+from .metrics import mongo_query_time
 from .trafarets import FilePath
+from .usage import UsageLedger
 
 
-class Config(namedtuple('BaseConfig', 'token, mongo, loglevel, sslchain, sslprivkey,reaction_threshold,sample_df')):
+class Config(namedtuple('BaseConfig', 'token, mongo, loglevel, sslchain, sslprivkey,reaction_threshold,sample_df,'
+                                         'reactions_refresh,usage_flush_interval,repetition_radius,'
+                                         'fingerprint_workers,fingerprint_queue,photo_min_side,download_limit,model,'
+                                         'update_workers,update_queue,update_overflow,'
+                                         'send_rate,chat_send_rate,group_send_rate,http,'
+                                         'webhook_url,poll_limit,poll_timeout,'
+                                         'admin_token,profile_dir,profile_seconds,record_updates,'
+                                         'fingerprint_cache_size,fingerprint_memory,'
+                                         'fingerprint_retention,fingerprints_per_chat')):
     __slots__ = ()
     mongo_uri_re = re.compile(
         r'^(?:mongodb)://'  # mongodb://
@@ -29,8 +45,46 @@ class Config(namedtuple('BaseConfig', 'token, mongo, loglevel, sslchain, sslpriv
             'db': 'talkbot'
         },
         'loglevel': 'DEBUG',
+        # required to serve the webhook only
+        'sslchain': '',
+        'sslprivkey': '',
         'reaction_threshold': 4,
-        'sample_df': "sample.csv",
+        # training sample to fit the model from when the model artifact can't be used
+        'sample_df': '',
+        'reactions_refresh': 60,
+        'usage_flush_interval': 10,
+        'repetition_radius': 24,
+        'fingerprint_workers': 2,
+        'fingerprint_queue': 32,
+        'photo_min_side': 320,
+        'download_limit': 5 * 1024 * 1024,
+        'model': "model.pkl",
+        'update_workers': 8,
+        'update_queue': 1000,
+        'update_overflow': 'reject',
+        'send_rate': 30,
+        'chat_send_rate': 1,
+        'group_send_rate': 20 / 60,
+        'http': {
+            'api_connections': 10,
+            'file_connections': 4,
+            'keepalive_timeout': 30,
+            'api_uri': "https://api.telegram.org/bot{token}/",
+            'file_uri': "https://api.telegram.org/file/bot{token}/",
+        },
+        'webhook_url': "https://talkbot1.mediasapiens.org/updates/",
+        'poll_limit': 100,
+        'poll_timeout': 30,
+        'admin_token': '',
+        'profile_dir': "profiles",
+        'profile_seconds': 60,
+        'record_updates': '',
+        'fingerprint_cache_size': 10000,
+        'fingerprint_memory': 256 * 1024 * 1024,
+        # days, 0 keeps fingerprints forever
+        'fingerprint_retention': 0,
+        # 0 keeps every fingerprint of a chat
+        'fingerprints_per_chat': 0,
     }
 
     trafaret = t.Dict({
@@ -40,21 +94,56 @@ class Config(namedtuple('BaseConfig', 'token, mongo, loglevel, sslchain, sslpriv
             'db': t.String
         }),
         'loglevel': t.Enum('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'),
-        'sslchain': FilePath(),
-        'sslprivkey': FilePath(),
-        'sample_df': FilePath(),
-        'reaction_threshold': t.Int
+        'sslchain': FilePath(allow_blank=True),
+        'sslprivkey': FilePath(allow_blank=True),
+        'sample_df': FilePath(allow_blank=True),
+        'reaction_threshold': t.Int,
+        'reactions_refresh': t.Int(gt=0),
+        'usage_flush_interval': t.Int(gt=0),
+        'repetition_radius': t.Int(gte=0),
+        'fingerprint_workers': t.Int(gt=0),
+        'fingerprint_queue': t.Int(gte=0),
+        'photo_min_side': t.Int(gt=0),
+        'download_limit': t.Int(gt=0),
+        'model': t.String,
+        'update_workers': t.Int(gt=0),
+        'update_queue': t.Int(gt=0),
+        'update_overflow': t.Enum('reject', 'drop_new', 'drop_oldest'),
+        'send_rate': t.Float(gt=0),
+        'chat_send_rate': t.Float(gt=0),
+        'group_send_rate': t.Float(gt=0),
+        'http': t.Dict({
+            'api_connections': t.Int(gt=0),
+            'file_connections': t.Int(gt=0),
+            'keepalive_timeout': t.Float(gte=0),
+            'api_uri': t.String,
+            'file_uri': t.String,
+        }),
+        'webhook_url': t.URL,
+        'poll_limit': t.Int(gte=1, lte=100),
+        'poll_timeout': t.Int(gte=0),
+        'admin_token': t.String(allow_blank=True),
+        'profile_dir': t.String,
+        'profile_seconds': t.Int(gt=0),
+        'record_updates': t.String(allow_blank=True),
+        'fingerprint_cache_size': t.Int(gte=0),
+        'fingerprint_memory': t.Int(gt=0),
+        'fingerprint_retention': t.Int(gte=7) | t.Atom(0),
+        'fingerprints_per_chat': t.Int(gte=0),
     })
 
     @classmethod
     def load_config(cls, dict_object):
         default = cls.default.copy()
         default.update(dict_object)
+        default['http'] = dict(cls.default['http'], **dict_object.get('http', {}))
 
         valid_conf = cls.trafaret.check(default)
 
         Mongo = namedtuple('BaseMongoConfig', 'uri, db')
         valid_conf['mongo'] = Mongo(**valid_conf['mongo'])
+        Http = namedtuple('BaseHttpConfig', 'api_connections, file_connections, keepalive_timeout, api_uri, file_uri')
+        valid_conf['http'] = Http(**valid_conf['http'])
         return cls(**valid_conf)
 
     def to_dict(self):
@@ -79,6 +168,7 @@ class User(namedtuple('BaseUser', 'id,ext_id,first_name,last_name,username')):
 class StorableMix:
 
     collection = None
+    indexes = ()
 
     @classmethod
     def from_dict(cls, **kwargs):
@@ -86,7 +176,8 @@ class StorableMix:
         if '_id' in kwargs:
             mutable['id'] = mutable.pop('_id')
         checked = cls.trafaret.check(mutable)
-        return cls(**checked)
+        # optional fields missing in the document
+        return cls(**dict(dict.fromkeys(cls._fields), **checked))
 
     def to_dict(self):
         dict_repr = self._asdict()
@@ -97,7 +188,8 @@ class StorableMix:
     @inject.params(db=AsyncIOMotorDatabase)
     async def create(cls, data_dict, db=None):
         valid_data = cls.trafaret.check(data_dict)
-        res = await db[cls.collection].insert_one(valid_data)
+        with mongo_query_time.time(entity=cls.collection, operation='insert_one'):
+            res = await db[cls.collection].insert_one(valid_data)
         data_dict['id'] = res.inserted_id
         return cls.from_dict(**data_dict)
 
@@ -108,13 +200,25 @@ class StorableMix:
 
     @classmethod
     @inject.params(db=AsyncIOMotorDatabase)
-    def find_one(cls, query=None, db=None):
-        return db[cls.collection].find_one(query)
+    async def find_one(cls, query=None, db=None):
+        with mongo_query_time.time(entity=cls.collection, operation='find_one'):
+            return await db[cls.collection].find_one(query)
+
+    @classmethod
+    @inject.params(db=AsyncIOMotorDatabase)
+    async def ensure_indexes(cls, db=None):
+        if not cls.indexes:
+            return []
+        # creation of an existing index with the same options is a no-op
+        return await db[cls.collection].create_indexes(list(cls.indexes))
 
 
 class Reaction(namedtuple('BaseReaction', 'id,patterns,image_url,image_id,text,created_at,created_by,last_used'),
                StorableMix):
     collection = 'reactions'
+    indexes = (
+        IndexModel([('patterns', ASCENDING)], name='patterns'),
+    )
 
     trafaret = t.Dict({
         'id': t.Or(t.String | MongoId(allow_blank=True)),
@@ -132,25 +236,191 @@ class Reaction(namedtuple('BaseReaction', 'id,patterns,image_url,image_id,text,c
     def find_by_pattern(cls, patterns, db=None):
         return db[cls.collection].find({'patterns': {'$in': patterns}})
 
-    @inject.params(db=AsyncIOMotorDatabase)
-    def update_usage(self, db=None):
-        epoch_now = int(time.time())
-        return db[self.collection].update({'_id': self.id}, {'$set': {'last_used': epoch_now}})
+    @inject.params(ledger=UsageLedger)
+    def update_usage(self, ledger=None):
+        ledger.touch(self.id)
 
     @property
-    @inject.params(config=Config)
-    def on_hold(self, config=None):
+    @inject.params(config=Config, ledger=UsageLedger)
+    def on_hold(self, config=None, ledger=None):
         epoch_now = int(time.time())
-        return self.last_used >= (epoch_now - config.reaction_threshold * 60)
+        return ledger.get(self.id, self.last_used) >= (epoch_now - config.reaction_threshold * 60)
 
 
-class ImageFinger(namedtuple('ImageFinger', 'id,vectors,message,file_id,chat_id'),
+class ImageFinger(namedtuple('ImageFinger', 'id,vectors,message,file_id,chat_id,version,message_id,posted_at'),
                   StorableMix):
+    """Image fingerprint.
+
+    Version 1 stores `vectors` as a list of `[name, bits]` pairs, version 2
+    stores all hash variants packed into a single binary blob in the model
+    features order.
+
+    Only `message_id` and `posted_at` of the message are stored, documents
+    written before that keep the whole `message` until compacted.
+    """
     collection = 'images'
+    indexes = (
+        IndexModel([('chat_id', ASCENDING), ('file_id', ASCENDING)], name='chat_file'),
+    )
+    RETENTION_INDEX = 'posted_at_ttl'
+    INDEX_OPTIONS_CONFLICT = 85
+    VERSION = 2
+
     trafaret = t.Dict({
         'id': t.Or(t.String | MongoId(allow_blank=True)),
-        'vectors': t.Any,
-        'message': t.Dict().allow_extra('*'),
+        t.Key('version', default=1): t.Enum(1, 2),
+        'vectors': t.Type(bytes) | t.List(t.List(t.Any, min_length=2, max_length=2)),
+        t.Key('message', optional=True): t.Dict().allow_extra('*'),
+        t.Key('message_id', optional=True): t.Int,
+        t.Key('posted_at', optional=True): t.Type(datetime.datetime),
         'file_id': t.String,
         'chat_id': t.Int
     })
+
+    @staticmethod
+    def message_fields(message):
+        return {
+            'message_id': message['message_id'],
+            'posted_at': datetime.datetime.utcfromtimestamp(message['date']),
+        }
+
+    @classmethod
+    @inject.params(config=Config, db=AsyncIOMotorDatabase)
+    async def ensure_indexes(cls, config=None, db=None):
+        names = await super().ensure_indexes(db=db)
+        collection = db[cls.collection]
+        if not config.fingerprint_retention:
+            # an index left from a retention set earlier would keep expiring fingerprints
+            if cls.RETENTION_INDEX in await collection.index_information():
+                await collection.drop_index(cls.RETENTION_INDEX)
+            return names
+
+        seconds = config.fingerprint_retention * 24 * 60 * 60
+        retention = IndexModel([('posted_at', ASCENDING)], name=cls.RETENTION_INDEX, expireAfterSeconds=seconds)
+        try:
+            names.extend(await collection.create_indexes([retention]))
+        except OperationFailure as ex:
+            if ex.code != cls.INDEX_OPTIONS_CONFLICT:
+                raise
+            # the index exists with another retention window
+            await db.command('collMod', cls.collection, index={
+                'name': cls.RETENTION_INDEX,
+                'expireAfterSeconds': seconds,
+            })
+            names.append(cls.RETENTION_INDEX)
+        return names
+
+    @classmethod
+    @inject.params(db=AsyncIOMotorDatabase)
+    async def trim_chat(cls, chat_id, cap, db=None):
+        """Deletes all but `cap` latest fingerprints of the chat, returns the number deleted."""
+        collection = db[cls.collection]
+        cursor = collection.find({'chat_id': chat_id}, {'_id': True}).sort('_id', DESCENDING).skip(cap)
+        stale = [document['_id'] async for document in cursor]
+        if not stale:
+            return 0
+        with mongo_query_time.time(entity=cls.collection, operation='trim'):
+            result = await collection.delete_many({'_id': {'$in': stale}})
+        return result.deleted_count
+
+    @classmethod
+    @inject.params(config=Config, db=AsyncIOMotorDatabase)
+    async def compact(cls, batch_size=500, config=None, db=None):
+        """Strips stored messages down to the used fields and trims chats over the cap."""
+        collection = db[cls.collection]
+        compacted = 0
+        requests = []
+
+        legacy = {'message': {'$type': 'object'}}
+        async for document in collection.find(legacy, {'message.message_id': True, 'message.date': True}):
+            requests.append(UpdateOne(
+                {'_id': document['_id']},
+                {'$set': cls.message_fields(document['message']), '$unset': {'message': ''}}
+            ))
+            if len(requests) >= batch_size:
+                result = await collection.bulk_write(requests, ordered=False)
+                compacted += result.modified_count
+                requests = []
+
+        if requests:
+            result = await collection.bulk_write(requests, ordered=False)
+            compacted += result.modified_count
+
+        trimmed = 0
+        if config.fingerprints_per_chat:
+            for chat_id in await collection.distinct('chat_id'):
+                trimmed += await cls.trim_chat(chat_id, config.fingerprints_per_chat, db=db)
+        return compacted, trimmed
+
+    @staticmethod
+    def encode_vectors(packed):
+        return Binary(packed.tobytes())
+
+    @staticmethod
+    def decode_vectors(vectors, version, names):
+        if version == 1:
+            return pack_hashes(dict(vectors), names)
+        return numpy.frombuffer(vectors, dtype=numpy.uint8).reshape(len(names), -1)
+
+    @classmethod
+    @inject.params(index=FingerprintIndex)
+    async def create(cls, data_dict, index=None):
+        finger = await super().create(data_dict)
+        index.add(finger.chat_id, index.from_document(finger.to_dict()))
+        return finger
+
+    @classmethod
+    @inject.params(db=AsyncIOMotorDatabase)
+    async def migrate_vectors(cls, names, batch_size=500, db=None):
+        collection = db[cls.collection]
+        legacy = {'version': {'$exists': False}}
+        migrated = 0
+        requests = []
+
+        async for document in collection.find(legacy, {'vectors': True}):
+            packed = cls.decode_vectors(document['vectors'], 1, names)
+            requests.append(UpdateOne(
+                {'_id': document['_id'], 'version': {'$exists': False}},
+                {'$set': {'vectors': cls.encode_vectors(packed), 'version': cls.VERSION}}
+            ))
+            if len(requests) >= batch_size:
+                result = await collection.bulk_write(requests, ordered=False)
+                migrated += result.modified_count
+                requests = []
+
+        if requests:
+            result = await collection.bulk_write(requests, ordered=False)
+            migrated += result.modified_count
+        return migrated
+
+
+class FileFingerprint(namedtuple('FileFingerprint', 'id,vectors,version,created_at'), StorableMix):
+    """Fingerprint of a file shared by all chats, keyed by Telegram `file_unique_id`.
+
+    Documents expire `TTL` seconds after they were stored.
+    """
+    collection = 'file_fingerprints'
+    TTL = 30 * 24 * 60 * 60
+    indexes = (
+        IndexModel([('created_at', ASCENDING)], name='created_at_ttl', expireAfterSeconds=TTL),
+    )
+
+    trafaret = t.Dict({
+        'id': t.String,
+        'vectors': t.Type(bytes),
+        'version': t.Enum(2),
+        'created_at': t.Type(datetime.datetime),
+    })
+
+    decode_vectors = staticmethod(ImageFinger.decode_vectors)
+
+    @classmethod
+    @inject.params(db=AsyncIOMotorDatabase)
+    async def store(cls, file_unique_id, packed, db=None):
+        document = {
+            'vectors': ImageFinger.encode_vectors(packed),
+            'version': ImageFinger.VERSION,
+            'created_at': datetime.datetime.utcnow(),
+        }
+        with mongo_query_time.time(entity=cls.collection, operation='upsert'):
+            await db[cls.collection].update_one({'_id': file_unique_id}, {'$setOnInsert': document}, upsert=True)
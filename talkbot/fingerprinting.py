@@ -0,0 +1,167 @@
+import asyncio
+import cProfile
+import io
+import os
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+from .hamming import pack_hashes
+from .logger import log
+from .metrics import Counter, Histogram
+from .utils import calc_scores, FEATURES
+
+
+cpu_time = Histogram('talkbot_fingerprint_cpu_seconds', "CPU time of fingerprinting an image in a worker")
+cache_lookups = Counter('talkbot_fingerprint_cache_lookups_total', "Fingerprint cache lookups by result", ['result'])
+fingerprints_rejected = Counter('talkbot_fingerprints_rejected_total',
+                                "Images not fingerprinted because the queue was full")
+pool_restarts = Counter('talkbot_fingerprint_pool_restarts_total', "Worker pools replaced after a worker died")
+
+
+class FingerprintQueueFull(Exception):
+    pass
+
+
+def fingerprint(data):
+    """Decodes image `data` and returns its packed hashes, runs in a worker process."""
+    scores = calc_scores(Image.open(io.BytesIO(data)))
+    return pack_hashes(dict((name, img_hash.hash) for name, img_hash in scores), FEATURES)
+
+
+# profile of the session a worker process takes part in, as (prefix, profile)
+_worker_profile = None
+
+
+def profiled(prefix, func, *args):
+    """Calls `func` under the worker profile of session `prefix`, stats are dumped after every call."""
+    global _worker_profile
+    if _worker_profile is None or _worker_profile[0] != prefix:
+        _worker_profile = prefix, cProfile.Profile()
+    profile = _worker_profile[1]
+    try:
+        return profile.runcall(func, *args)
+    finally:
+        profile.dump_stats('%s-worker-%d.pstats' % (prefix, os.getpid()))
+
+
+def timed_fingerprint(data, profile_prefix=None):
+    started = time.process_time()
+    if profile_prefix is None:
+        packed = fingerprint(data)
+    else:
+        packed = profiled(profile_prefix, fingerprint, data)
+    return packed, time.process_time() - started
+
+
+def warm_up():
+    pass
+
+
+class FingerprintService:
+    """Computes image fingerprints in a pool of worker processes.
+
+    At most `workers + queue_size` images are accepted at once, further
+    images are rejected with FingerprintQueueFull right away. A worker that
+    dies breaks the whole pool, so it is replaced and only the images being
+    fingerprinted at that moment fail with BrokenProcessPool. While
+    `profile_prefix` is set workers profile fingerprinting and dump their
+    stats next to it.
+    """
+
+    def __init__(self, workers, queue_size, loop=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = None
+        self.pending = 0
+        self.profile_prefix = None
+
+    def full(self):
+        return self.pending >= self.workers + self.queue_size
+
+    def start(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        # fork the workers now, before the process has other threads
+        for _ in range(self.workers):
+            self.executor.submit(warm_up)
+
+    def restart(self, broken):
+        if self.executor is not broken:
+            # replaced already by another image that failed with it
+            return
+        log.warning("Fingerprinting worker died, restarting the pool")
+        pool_restarts.inc()
+        broken.shutdown(wait=False)
+        self.start()
+
+    async def shutdown(self):
+        if self.executor is None:
+            return
+        executor, self.executor = self.executor, None
+        # executor shutdown blocks until running jobs are finished
+        await self.loop.run_in_executor(None, executor.shutdown, True)
+
+    async def fingerprint(self, data):
+        if self.full():
+            fingerprints_rejected.inc()
+            raise FingerprintQueueFull("%d images are being fingerprinted already" % self.pending)
+
+        self.pending += 1
+        executor = self.executor
+        try:
+            packed, spent = await self.loop.run_in_executor(executor, timed_fingerprint, data, self.profile_prefix)
+        except BrokenProcessPool:
+            self.restart(executor)
+            raise
+        finally:
+            self.pending -= 1
+        # metrics of worker processes are not collected, so the time is reported back
+        cpu_time.observe(spent)
+        return packed
+
+
+class FingerprintCache:
+    """Fingerprints of files shared between chats.
+
+    Recently used fingerprints are kept in an LRU of `size` entries in front
+    of the `entity` collection, so a file posted again anywhere is neither
+    downloaded nor hashed.
+    """
+
+    def __init__(self, entity, names, size):
+        self.entity = entity
+        self.names = names
+        self.size = size
+        self.items = OrderedDict()
+
+    def _remember(self, key, packed):
+        self.items[key] = packed
+        self.items.move_to_end(key)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    async def get(self, key):
+        packed = self.items.get(key)
+        if packed is not None:
+            self.items.move_to_end(key)
+            cache_lookups.inc(result='memory')
+            return packed
+
+        document = await self.entity.find_one({'_id': key})
+        if document is None:
+            cache_lookups.inc(result='miss')
+            return None
+
+        cache_lookups.inc(result='storage')
+        packed = self.entity.decode_vectors(document['vectors'], document['version'], self.names)
+        self._remember(key, packed)
+        return packed
+
+    async def put(self, key, packed):
+        self._remember(key, packed)
+        await self.entity.store(key, packed)
@@ -0,0 +1,279 @@
+import asyncio
+import itertools
+
+from collections import OrderedDict, namedtuple
+
+import inject
+import numpy
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from .metrics import Counter, Gauge, mongo_query_time
+
+
+CHUNK_BITS = 16
+
+POPCOUNT = numpy.array([bin(value).count('1') for value in range(256)], dtype=numpy.uint8)
+
+resident_bytes = Gauge('talkbot_fingerprints_resident_bytes', "Memory of resident chat fingerprints")
+resident_chats = Gauge('talkbot_fingerprints_resident_chats', "Chats with fingerprints held in memory")
+chat_lookups = Counter('talkbot_fingerprints_chat_lookups_total', "Resident chat lookups by result", ['result'])
+chats_evicted = Counter('talkbot_fingerprints_chats_evicted_total', "Chats evicted from memory")
+
+IndexedFinger = namedtuple('IndexedFinger', 'message_id, file_id, packed')
+# fingerprint held by a chat, `row` is its position there
+ResidentFinger = namedtuple('ResidentFinger', 'row, message_id, packed')
+
+
+def pack_hashes(hashes, names):
+    """Packs `hashes` mapping into (variants, bytes) matrix ordered by `names`."""
+    return numpy.stack([numpy.packbits(numpy.asarray(hashes[name], dtype=numpy.bool_).flatten())
+                        for name in names])
+
+
+def hamming_distances(packed, stack):
+    """Distances between `packed` hashes and every matrix of `stack` per variant."""
+    return POPCOUNT[numpy.bitwise_xor(stack, packed)].sum(axis=-1)
+
+
+def flip_masks(bits, distance):
+    """All masks of `bits` length with at most `distance` bits set."""
+    return [sum(1 << position for position in positions)
+            for weight in range(distance + 1)
+            for positions in itertools.combinations(range(bits), weight)]
+
+
+class MultiIndex:
+    """Multi-index hashing table for packed codes of several variants.
+
+    Every variant of a code is split into chunks of CHUNK_BITS. Any code
+    within `radius` of the query in a variant has at least one chunk of that
+    variant within `radius // chunks` bits, so only those chunk values are
+    probed and the collected rows are verified against the full codes.
+
+    The chunk tables are one sorted array of keys, made of the variant, the
+    chunk position and its value, with a parallel array of rows. Codes added
+    since the last merge are verified directly until more than MERGE_ROWS of
+    them pile up, so loading a chat sorts the keys once.
+    """
+    MERGE_ROWS = 64
+
+    def __init__(self, bits, radius, variants=1):
+        assert bits % CHUNK_BITS == 0, "codes are split into whole chunks"
+        self.chunks = bits // CHUNK_BITS
+        self.radius = radius
+        self.masks = numpy.array(flip_masks(CHUNK_BITS, radius // self.chunks), dtype=numpy.uint32)
+        positions = numpy.arange(variants * self.chunks, dtype=numpy.uint32).reshape(variants, self.chunks)
+        self.positions = positions << CHUNK_BITS
+        self.codes = numpy.zeros((0, variants, bits // 8), dtype=numpy.uint8)
+        self.size = 0
+        self.merged = 0
+        self.keys = numpy.zeros(0, dtype=numpy.uint32)
+        self.rows = numpy.zeros(0, dtype=numpy.int32)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.keys.nbytes + self.rows.nbytes
+
+    def _chunk_keys(self, codes):
+        """Keys of all chunks of `codes` shaped (..., variants, bytes)."""
+        values = numpy.ascontiguousarray(codes).view('>u2').astype(numpy.uint32)
+        return values | self.positions
+
+    def add(self, code):
+        if self.size == len(self.codes):
+            grown = numpy.zeros((max(2 * self.size, 16),) + self.codes.shape[1:], dtype=numpy.uint8)
+            grown[:self.size] = self.codes[:self.size]
+            self.codes = grown
+        row = self.size
+        self.codes[row] = code
+        self.size += 1
+        return row
+
+    def _merge(self):
+        keys = self._chunk_keys(self.codes[self.merged:self.size]).reshape(self.size - self.merged, -1)
+        rows = numpy.repeat(numpy.arange(self.merged, self.size, dtype=numpy.int32), keys.shape[1])
+        keys = keys.ravel()
+        order = numpy.argsort(keys, kind='mergesort')
+        keys, rows = keys[order], rows[order]
+        if self.merged:
+            at = numpy.searchsorted(self.keys, keys)
+            keys, rows = numpy.insert(self.keys, at, keys), numpy.insert(self.rows, at, rows)
+        self.keys, self.rows, self.merged = keys, rows, self.size
+
+    def search(self, code):
+        """Sorted rows of codes within `radius` of `code` in any variant."""
+        if self.size - self.merged > self.MERGE_ROWS:
+            self._merge()
+
+        probes = (self._chunk_keys(code)[..., numpy.newaxis] ^ self.masks).ravel()
+        starts = numpy.searchsorted(self.keys, probes, side='left')
+        counts = numpy.searchsorted(self.keys, probes, side='right') - starts
+        # positions of all keys equal to any probe
+        hits = numpy.repeat(starts - numpy.cumsum(counts) + counts, counts) + numpy.arange(counts.sum())
+        rows = numpy.union1d(self.rows[hits], numpy.arange(self.merged, self.size))
+        if not len(rows):
+            return rows
+        return rows[(hamming_distances(code, self.codes[rows]) <= self.radius).any(axis=1)]
+
+
+class ChatFingerprints:
+    """Fingerprints of a single chat indexed by every hash variant.
+
+    Packed hashes are held by the multi-index, message ids and hashes of
+    file ids are kept in parallel arrays growing by doubling. Everything is
+    in numpy arrays, so `nbytes` is the memory the chat takes.
+    """
+    NO_MESSAGE = -1
+
+    def __init__(self, radius):
+        self.radius = radius
+        self.index = None
+        self.message_ids = numpy.zeros(0, dtype=numpy.int64)
+        self.file_keys = numpy.zeros(0, dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.index) if self.index is not None else 0
+
+    @property
+    def nbytes(self):
+        arrays = self.message_ids.nbytes + self.file_keys.nbytes
+        return arrays + (self.index.nbytes if self.index is not None else 0)
+
+    def add(self, finger):
+        if self.index is None:
+            variants, width = finger.packed.shape
+            self.index = MultiIndex(width * 8, self.radius, variants)
+
+        row = self.index.add(finger.packed)
+        if row == len(self.message_ids):
+            capacity = max(2 * row, 16)
+            self.message_ids = numpy.resize(self.message_ids, capacity)
+            self.file_keys = numpy.resize(self.file_keys, capacity)
+        self.message_ids[row] = self.NO_MESSAGE if finger.message_id is None else finger.message_id
+        # file ids are only looked up within a process, their hashes are enough
+        self.file_keys[row] = hash(finger.file_id)
+        return row
+
+    def get(self, row):
+        message_id = int(self.message_ids[row])
+        return ResidentFinger(row=int(row), message_id=None if message_id == self.NO_MESSAGE else message_id,
+                              packed=self.index.codes[row])
+
+    def find_file(self, file_ids):
+        """Stored fingerprint of any of `file_ids` or None."""
+        rows = numpy.flatnonzero(numpy.isin(self.file_keys[:len(self)], [hash(file_id) for file_id in file_ids]))
+        return self.get(rows[0]) if len(rows) else None
+
+    def candidates(self, packed):
+        if self.index is None:
+            return []
+        return [self.get(row) for row in self.index.search(packed)]
+
+
+class FingerprintIndex:
+    """Near-duplicate candidates lookup keyed by chat.
+
+    A chat is loaded from the collection on first use and then kept in sync
+    by `add` whenever a new fingerprint is stored. Least recently used chats
+    are evicted once resident chats take more than `budget` bytes, the chat
+    in use is always kept. Chats are trimmed to `cap` latest fingerprints
+    once they are a tenth over it.
+    """
+
+    def __init__(self, entity, names, radius, budget=None, cap=None):
+        self.entity = entity
+        self.names = names
+        self.radius = radius
+        self.budget = budget
+        self.cap = cap
+        self.chats = OrderedDict()
+        self.nbytes = 0
+        self._locks = {}
+        self._trimming = set()
+        resident_bytes.function = lambda: self.nbytes
+        resident_chats.function = lambda: len(self.chats)
+
+    def from_document(self, document):
+        message_id = document.get('message_id')
+        if message_id is None:
+            # stored before messages were stripped down to the used fields
+            message_id = document['message']['message_id']
+        return IndexedFinger(
+            message_id=message_id,
+            file_id=document['file_id'],
+            packed=self.entity.decode_vectors(document['vectors'], document.get('version', 1), self.names)
+        )
+
+    def _evict(self):
+        while self.budget is not None and self.nbytes > self.budget and len(self.chats) > 1:
+            chat_id, chat = self.chats.popitem(last=False)
+            self.nbytes -= chat.nbytes
+            chats_evicted.inc()
+
+    @inject.params(db=AsyncIOMotorDatabase)
+    async def get(self, chat_id, db=None):
+        chat = self.chats.get(chat_id)
+        if chat is not None:
+            self.chats.move_to_end(chat_id)
+            chat_lookups.inc(result='hit')
+            return chat
+
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                chat_lookups.inc(result='miss')
+                chat = ChatFingerprints(self.radius)
+                projection = {'vectors': True, 'version': True, 'file_id': True, 'message_id': True,
+                              'message.message_id': True}
+                with mongo_query_time.time(entity=self.entity.collection, operation='load_chat'):
+                    async for document in db[self.entity.collection].find({'chat_id': chat_id}, projection):
+                        chat.add(self.from_document(document))
+                self.chats[chat_id] = chat
+                self.nbytes += chat.nbytes
+                self._evict()
+        self._locks.pop(chat_id, None)
+        return chat
+
+    def add(self, chat_id, finger):
+        # not loaded chats will read it from the collection on first use
+        chat = self.chats.get(chat_id)
+        if chat is not None:
+            before = chat.nbytes
+            chat.add(finger)
+            self.nbytes += chat.nbytes - before
+            self.chats.move_to_end(chat_id)
+            self._evict()
+
+    def discard(self, chat_id):
+        chat = self.chats.pop(chat_id, None)
+        if chat is not None:
+            self.nbytes -= chat.nbytes
+
+    def needs_trim(self, chat_id):
+        chat = self.chats.get(chat_id)
+        return (bool(self.cap) and chat is not None and chat_id not in self._trimming
+                and len(chat) > self.cap + self.cap // 10)
+
+    async def trim(self, chat_id):
+        """Deletes fingerprints of the chat over the cap, returns the number deleted."""
+        self._trimming.add(chat_id)
+        try:
+            deleted = await self.entity.trim_chat(chat_id, self.cap)
+        finally:
+            self._trimming.discard(chat_id)
+        # rows can't be removed from multi-indexes, the chat is loaded again on next use
+        self.discard(chat_id)
+        return deleted
+
+    async def find_file(self, chat_id, file_ids):
+        chat = await self.get(chat_id)
+        return chat.find_file(file_ids)
+
+    async def candidates(self, chat_id, packed):
+        chat = await self.get(chat_id)
+        return chat.candidates(packed)
@@ -0,0 +1,232 @@
+import asyncio
+import hashlib
+import io
+import json
+import time
+
+from collections import Counter
+
+import numpy
+import uvloop
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer, unused_port
+from PIL import Image, ImageDraw, ImageFilter
+
+from .entities import Config
+from .logger import log
+from .main import create_app
+
+
+def replay_config(config, database):
+    """`config` storing into `database`, refuses the configured one as replay writes fingerprints and usage."""
+    mongo = dict(Config.default['mongo'], **config.get('mongo', {}))
+    if database == mongo['db']:
+        raise ValueError("Replay needs a database other than the configured '%s'" % database)
+    return dict(config, mongo=dict(mongo, db=database))
+
+
+def make_photo(width, height, seed=0):
+    """JPEG of blurred shapes on a smooth background with sensor-like noise, hashes like a real photo."""
+    rnd = numpy.random.RandomState(seed)
+    background = rnd.rand(height // 16 + 2, width // 16 + 2, 3) * 255
+    img = Image.fromarray(background.astype(numpy.uint8)).resize((width, height), Image.BICUBIC)
+
+    draw = ImageDraw.Draw(img)
+    for _ in range(15):
+        x0, y0 = rnd.randint(0, width), rnd.randint(0, height)
+        x1, y1 = x0 + rnd.randint(10, width // 2), y0 + rnd.randint(10, height // 2)
+        draw.ellipse([x0, y0, x1, y1], fill=tuple(rnd.randint(0, 255, 3)))
+
+    noisy = numpy.asarray(img, dtype=numpy.float64) + rnd.normal(0, 8, (height, width, 3))
+    img = Image.fromarray(noisy.clip(0, 255).astype(numpy.uint8)).filter(ImageFilter.GaussianBlur(1))
+
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def load_recording(path):
+    with open(path, encoding='utf-8') as recording:
+        return [json.loads(line) for line in recording if line.strip()]
+
+
+def percentile(values, q):
+    return float(numpy.percentile(values, q)) if values else None
+
+
+class FakeTelegramApi:
+    """Local stand-in for the Bot API answering the calls the bot makes.
+
+    Downloads return a synthetic JPEG derived from the file path, so the
+    same photo replayed twice is detected as a repetition.
+    """
+    IMAGE_SIZE = (800, 600)
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.calls = Counter()
+        self.images = {}
+        self.message_id = 0
+        self.app = web.Application(loop=loop)
+        self.app.router.add_route('*', '/bot{token}/{method}', self.on_method)
+        self.app.router.add_route('GET', '/file/bot{token}/{path:.+}', self.on_file)
+        self.server = None
+
+    async def start(self):
+        self.server = TestServer(self.app, loop=self.loop, port=unused_port())
+        await self.server.start_server(loop=self.loop)
+        return str(self.server.make_url('/'))
+
+    async def close(self):
+        await self.server.close()
+
+    async def on_method(self, request):
+        method = request.match_info['method']
+        self.calls[method] += 1
+        params = await request.post() if request.method == 'POST' else request.query
+
+        if method == 'getFile':
+            result = {'file_id': params['file_id'], 'file_path': 'photos/%s.jpg' % params['file_id']}
+        elif method in ('sendMessage', 'sendPhoto'):
+            self.message_id += 1
+            result = {'message_id': self.message_id, 'chat': {'id': int(params['chat_id'])}}
+        elif method == 'getUpdates':
+            result = []
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def on_file(self, request):
+        path = request.match_info['path']
+        self.calls['file'] += 1
+        image = self.images.get(path)
+        if image is None:
+            seed = int(hashlib.md5(path.encode('utf-8')).hexdigest()[:8], 16)
+            image = self.images[path] = make_photo(*self.IMAGE_SIZE, seed=seed)
+        return web.Response(body=image, content_type='image/jpeg')
+
+
+class ReplayStats:
+
+    def __init__(self):
+        self.sent = {}
+        self.ack_latency = []
+        self.latency = []
+        self.statuses = Counter()
+        self.failures = 0
+        self.errors = 0
+
+    def track(self, handler):
+        """Wraps the update handler to measure time from sending to processed."""
+        async def wrapper(update):
+            try:
+                return await handler(update)
+            except Exception:
+                self.errors += 1
+                raise
+            finally:
+                sent = self.sent.pop(update['update_id'], None)
+                if sent is not None:
+                    self.latency.append(time.perf_counter() - sent)
+        return wrapper
+
+    def report(self, elapsed, calls):
+        total = sum(self.statuses.values()) + self.failures
+        return {
+            'updates': total,
+            'elapsed': elapsed,
+            'throughput': len(self.latency) / elapsed if elapsed else None,
+            'ack_p50': percentile(self.ack_latency, 50),
+            'ack_p99': percentile(self.ack_latency, 99),
+            'latency_p50': percentile(self.latency, 50),
+            'latency_p99': percentile(self.latency, 99),
+            'statuses': dict((str(status), count) for status, count in self.statuses.items()),
+            'request_failures': self.failures,
+            'handler_errors': self.errors,
+            'error_rate': (total - self.statuses[200] + self.errors) / total if total else None,
+            'api_calls': dict(calls),
+        }
+
+
+async def post_updates(client, recording, stats, rate, concurrency, loop):
+    slots = asyncio.Semaphore(concurrency, loop=loop)
+    started = time.perf_counter()
+
+    async def post(update):
+        try:
+            stats.sent[update['update_id']] = sent = time.perf_counter()
+            async with client.post('/updates/', json=update) as resp:
+                stats.ack_latency.append(time.perf_counter() - sent)
+                stats.statuses[resp.status] += 1
+                if resp.status != 200:
+                    stats.sent.pop(update['update_id'], None)
+        except Exception:
+            log.error("Failed to post update %s", update['update_id'], exc_info=True)
+            stats.failures += 1
+            stats.sent.pop(update['update_id'], None)
+        finally:
+            slots.release()
+
+    tasks = []
+    for idx, line in enumerate(recording):
+        # replay at the recorded pace unless a fixed rate is given
+        due = idx / rate if rate else line['offset']
+        delay = started + due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay, loop=loop)
+
+        update = line['update']
+        message = update.get('message') or update.get('channel_post')
+        if message is not None:
+            # the bot ignores stale messages
+            message['date'] = int(time.time())
+        await slots.acquire()
+        tasks.append(loop.create_task(post(update)))
+
+    await asyncio.gather(*tasks, loop=loop)
+
+
+async def replay(loop, config, recording, database, rate=0, concurrency=10, drain_timeout=60.0):
+    """Replays `recording` against the webhook of an app talking to a fake API, returns the report.
+
+    The app stores into `database` instead of the configured one.
+    """
+    config = replay_config(config, database)
+    fake_api = FakeTelegramApi(loop)
+    api_url = await fake_api.start()
+    config = dict(config, http=dict(config.get('http', {}),
+                                    api_uri=api_url + 'bot{token}/',
+                                    file_uri=api_url + 'file/bot{token}/'))
+
+    app = create_app(loop, config)
+    client = TestClient(TestServer(app, loop=loop, port=unused_port()), loop=loop)
+    await client.start_server()
+    stats = ReplayStats()
+    updates = app['updates']
+    updates.handler = stats.track(updates.handler)
+
+    started = time.perf_counter()
+    try:
+        await post_updates(client, recording, stats, rate, concurrency, loop)
+
+        try:
+            await asyncio.wait_for(updates.join(), drain_timeout, loop=loop)
+        except asyncio.TimeoutError:
+            log.warning("Updates left unprocessed: %d", updates.qsize())
+        elapsed = time.perf_counter() - started
+    finally:
+        await client.close()
+        await fake_api.close()
+
+    return stats.report(elapsed, fake_api.calls)
+
+
+def run_replay(config, path, database, rate=0, concurrency=10):
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = uvloop.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(replay(loop, config, load_recording(path), database, rate, concurrency))
+    finally:
+        loop.close()
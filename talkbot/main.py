@@ -1,9 +1,14 @@
 import asyncio
+import functools
+import hmac
 import logging
+import signal
 import ssl
 
-import aiohttp
+from http import HTTPStatus
+
 import inject
+import trafaret as t
 import uvloop
 
 from aiohttp import web
@@ -11,16 +16,42 @@ from motor.motor_asyncio import AsyncIOMotorDatabase
 from sklearn.ensemble import GradientBoostingClassifier
 
 from .api_client import TelegramBot
-from .entities import Config
+from .entities import Config, Reaction, ImageFinger, FileFingerprint
+from .fingerprinting import FingerprintCache, FingerprintService
+from .hamming import FingerprintIndex
 from .logger import log, setup_logging
-from .storage import init_database
-from .utils import run_app, fit_model
+from .matcher import ReactionMatcher
+from .metrics import render, CONTENT_TYPE
+from .profiling import Profiler
+from .storage import init_database, ensure_indexes
+from .transport import ApiClient
+from .updates import UpdateQueue, UpdatePoller, UpdateRecorder, QueueFull, update_trafaret
+from .usage import UsageLedger
+from .utils import run_app, run_periodically, fit_model, fit_cascade, load_model, ModelMismatch, DuplicateCascade, \
+    FEATURES
+
 
+UPDATES_DRAIN_TIMEOUT = 30.0
 
-@inject.params(bot=TelegramBot)
-async def on_update(request, bot=None):
+
+@inject.params(updates=UpdateQueue)
+async def on_update(request, updates=None):
     data = await request.json()
-    await bot.on_update(data)
+    try:
+        update = update_trafaret.check(data)
+    except t.DataError as ex:
+        log.warning("Malformed update %s: %s", data, ex)
+        return web.Response(status=HTTPStatus.BAD_REQUEST)
+
+    recorder = request.app['recorder']
+    if recorder is not None:
+        recorder.record(update)
+
+    try:
+        updates.put(update)
+    except QueueFull as ex:
+        log.warning("%s", ex)
+        return web.Response(status=HTTPStatus.SERVICE_UNAVAILABLE)
     return web.Response()
 
 
@@ -29,20 +60,99 @@ async def on_ping(request):
     return web.Response(text='All OK')
 
 
+async def on_metrics(request):
+    return web.Response(body=render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+
+def admin_only(handler):
+    @functools.wraps(handler)
+    async def wrapper(request):
+        token = request.headers.get('X-Admin-Token', '').encode('utf-8')
+        if not hmac.compare_digest(token, request.app['config'].admin_token.encode('utf-8')):
+            return web.Response(status=HTTPStatus.FORBIDDEN)
+        return await handler(request)
+    return wrapper
+
+
+@admin_only
+async def on_profile_start(request):
+    try:
+        updates = int(request.query.get('updates', 0))
+        seconds = float(request.query.get('seconds', 0))
+    except ValueError:
+        return web.Response(status=HTTPStatus.BAD_REQUEST)
+    if not updates and not seconds:
+        seconds = request.app['config'].profile_seconds
+
+    if not request.app['profiler'].start(updates=updates, seconds=seconds):
+        return web.Response(status=HTTPStatus.CONFLICT, text="Profiling is already running")
+    return web.json_response({'updates': updates, 'seconds': seconds})
+
+
+@admin_only
+async def on_profile_stop(request):
+    return web.json_response({'path': request.app['profiler'].stop()})
+
+
+@admin_only
+async def on_memory_snapshot(request):
+    return web.json_response({'path': request.app['profiler'].snapshot()})
+
+
+@admin_only
+async def on_memory_stop(request):
+    request.app['profiler'].stop_tracing()
+    return web.Response()
+
+
+def load_image_model(config):
+    """Returns duplicate classifier and the cascade in front of it."""
+    try:
+        artifact = load_model(config.model)
+        cascade = DuplicateCascade(*artifact.get('cascade', DuplicateCascade.DISABLED))
+        log.info("Loaded model trained on %s, cascade %s", artifact['checksum'], cascade)
+        return artifact['model'], cascade
+    except FileNotFoundError:
+        problem = "model '%s' not found" % config.model
+    except ModelMismatch as ex:
+        problem = "model '%s' is outdated: %s" % (config.model, ex)
+
+    if not config.sample_df:
+        raise t.DataError({'sample_df': t.DataError("is required to train a model, %s" % problem)})
+    log.warning("Training from %s, %s", config.sample_df, problem)
+    return fit_model(config.sample_df), fit_cascade(config.sample_df)
+
+
 def on_startup(app):
-    connector = aiohttp.TCPConnector(limit=5, use_dns_cache=True, loop=app.loop)
-    session = aiohttp.ClientSession(connector=connector, raise_for_status=True)
-    bot = TelegramBot(app['config'].token, session)
-    image_model = fit_model(app['config'].sample_df)
+    api = ApiClient.from_config(app['config'].token, app['config'].http, loop=app.loop)
+    send_rates = app['config'].send_rate, app['config'].chat_send_rate, app['config'].group_send_rate
+    bot = TelegramBot(api, download_limit=app['config'].download_limit, send_rates=send_rates, loop=app.loop)
+    image_model, cascade = load_image_model(app['config'])
+    reactions = ReactionMatcher(loop=app.loop)
+    usage = UsageLedger(Reaction.collection)
+    fingerprints = FingerprintIndex(ImageFinger, FEATURES, app['config'].repetition_radius,
+                                    budget=app['config'].fingerprint_memory, cap=app['config'].fingerprints_per_chat)
+    fingerprinter = FingerprintService(app['config'].fingerprint_workers, app['config'].fingerprint_queue,
+                                       loop=app.loop)
+    fingerprinter.start()
+    fingerprint_cache = FingerprintCache(FileFingerprint, FEATURES, app['config'].fingerprint_cache_size)
+    updates = UpdateQueue(bot.on_update, app['config'].update_workers, app['config'].update_queue,
+                          overflow=app['config'].update_overflow, loop=app.loop)
 
     def config_injections(binder):
         # injection bindings
         binder.bind(Config, app['config'])
         binder.bind(TelegramBot, bot)
         binder.bind(GradientBoostingClassifier, image_model)
+        binder.bind(DuplicateCascade, cascade)
+        binder.bind(ReactionMatcher, reactions)
+        binder.bind(UsageLedger, usage)
+        binder.bind(FingerprintIndex, fingerprints)
+        binder.bind(FingerprintService, fingerprinter)
+        binder.bind(FingerprintCache, fingerprint_cache)
+        binder.bind(UpdateQueue, updates)
         binder.bind_to_constructor(AsyncIOMotorDatabase, init_database)
 
-
     try:
         inject.configure(config_injections)
     except inject.InjectorException:
@@ -50,14 +160,56 @@ def on_startup(app):
 
     setup_logging(log)
 
-    app.loop.create_task(bot.set_hook())
+    # in poll mode UpdatePoller hands updates to the bot directly
+    if app['mode'] == 'webhook':
+        updates.start()
+        app.loop.create_task(bot.set_hook(app['config'].webhook_url))
+    app['updates'] = updates
+    app['bot'] = bot
+    app['usage'] = usage
+    app['fingerprinter'] = fingerprinter
+    app['recorder'] = None
+    if app['config'].record_updates:
+        app['recorder'] = UpdateRecorder(app['config'].record_updates, secrets=[app['config'].token])
+        log.info("Recording updates to %s", app['config'].record_updates)
+    app['profiler'] = profiler = Profiler(updates, app['config'].profile_dir, fingerprinter=fingerprinter,
+                                          loop=app.loop)
+    app.loop.add_signal_handler(signal.SIGUSR1, profiler.toggle, app['config'].profile_seconds)
+    app.loop.add_signal_handler(signal.SIGUSR2, profiler.snapshot)
+    app['tasks'] = [
+        app.loop.create_task(ensure_indexes()),
+        app.loop.create_task(reactions.load()),
+        app.loop.create_task(run_periodically(app['config'].reactions_refresh, reactions.load, loop=app.loop)),
+        app.loop.create_task(run_periodically(app['config'].usage_flush_interval, usage.flush, loop=app.loop)),
+    ]
 
 
-def on_cleanup(app):
-    pass
+async def on_cleanup(app):
+    app['profiler'].stop()
+    if app['recorder'] is not None:
+        app['recorder'].close()
+    await app['updates'].stop(UPDATES_DRAIN_TIMEOUT)
+    await app['bot'].outbound.stop(UPDATES_DRAIN_TIMEOUT)
+    await app['bot'].api.close()
+
+    for task in app.get('tasks', []):
+        task.cancel()
+    await asyncio.gather(*app.get('tasks', []), loop=app.loop, return_exceptions=True)
+
+    try:
+        await app['usage'].flush()
+    except Exception:
+        log.error("Failed to flush reactions usage", exc_info=True)
+
+    await app['fingerprinter'].shutdown()
 
 
 def create_ssl_context(config):
+    missing = dict((key, t.DataError("is required to serve the webhook"))
+                   for key in ('sslchain', 'sslprivkey') if not getattr(config, key))
+    if missing:
+        raise t.DataError(missing)
+
     context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     try:
         context.load_cert_chain(config.sslchain, config.sslprivkey)
@@ -67,15 +219,22 @@ def create_ssl_context(config):
     return context
 
 
-def create_app(loop, config):
+def create_app(loop, config, mode='webhook'):
     app = web.Application(loop=loop, debug=True)
     app['config'] = Config.load_config(config)
+    app['mode'] = mode
 
     app.on_startup.append(on_startup)
     app.on_cleanup.append(on_cleanup)
 
     app.router.add_route('POST', '/updates/', on_update)
     app.router.add_route('GET', '/ping', on_ping)
+    app.router.add_route('GET', '/metrics', on_metrics)
+    if app['config'].admin_token:
+        app.router.add_route('POST', '/admin/profile/start', on_profile_start)
+        app.router.add_route('POST', '/admin/profile/stop', on_profile_stop)
+        app.router.add_route('POST', '/admin/memory/snapshot', on_memory_snapshot)
+        app.router.add_route('POST', '/admin/memory/stop', on_memory_stop)
 
     return app
 
@@ -92,3 +251,48 @@ def init(config):
     run_app(app, loop, ssl_context=ssl_context)
 
 
+def poll(config):
+    log.debug("Loglevel set to %s", logging.getLevelName(log.getEffectiveLevel()))
+    asyncio.set_event_loop(None)
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = uvloop.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    app = create_app(loop, config, mode='poll')
+    loop.run_until_complete(app.startup())
+
+    bot = app['bot']
+    poller = UpdatePoller(bot, bot.on_update, limit=app['config'].poll_limit, timeout=app['config'].poll_timeout,
+                          loop=loop)
+    app['profiler'].target = poller
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, poller.stop)
+
+    try:
+        # getUpdates is refused while a webhook is set
+        loop.run_until_complete(bot.delete_hook())
+        loop.run_until_complete(poller.run())
+    finally:
+        loop.run_until_complete(app.shutdown())
+        loop.run_until_complete(app.cleanup())
+        loop.close()
+
+
+def run_command(config, func, *args, **kwargs):
+    """Runs `func` coroutine with configured storage outside of the web application."""
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = uvloop.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app_config = Config.load_config(config)
+
+    def config_injections(binder):
+        binder.bind(Config, app_config)
+        binder.bind_to_constructor(AsyncIOMotorDatabase, init_database)
+
+    inject.clear_and_configure(config_injections)
+    setup_logging(log)
+
+    try:
+        return loop.run_until_complete(func(*args, **kwargs))
+    finally:
+        loop.close()
@@ -0,0 +1,220 @@
+import asyncio
+
+from collections import OrderedDict, deque
+
+import inject
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING
+
+from .entities import Reaction
+from .logger import log
+from .metrics import mongo_query_time
+
+
+class PatternAutomaton:
+    """Aho-Corasick automaton matching every known pattern in one pass.
+
+    Patterns given to the constructor are compiled right away, patterns added
+    later are compiled on the next search.
+    """
+
+    def __init__(self, patterns=()):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [set()]
+        self._matches = [set()]
+        self._dirty = False
+        for pattern in patterns:
+            self.add(pattern)
+        if self._dirty:
+            self._build()
+
+    def __len__(self):
+        return sum(len(out) for out in self._out)
+
+    def add(self, pattern):
+        if not pattern:
+            return
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(set())
+                self._goto[state][char] = next_state
+            state = next_state
+        self._out[state].add(pattern)
+        self._dirty = True
+
+    def _build(self):
+        # failure links have to be recalculated for the whole trie since a new
+        # pattern may become a suffix for the states inserted before
+        self._fail = [0] * len(self._goto)
+        self._matches = [set(out) for out in self._out]
+        queue = deque(self._goto[0].values())
+
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                # states are visited by depth, so the failure target is complete
+                self._matches[next_state] |= self._matches[self._fail[next_state]]
+
+        self._dirty = False
+
+    def search(self, text):
+        if self._dirty:
+            self._build()
+
+        goto, fail, matches = self._goto, self._fail, self._matches
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if matches[state]:
+                found.update(matches[state])
+        return found
+
+
+def index_patterns(reactions):
+    """Returns positions of `reactions` by pattern, patterns in order of appearance."""
+    by_pattern = OrderedDict()
+    for position, reaction in enumerate(reactions):
+        for pattern in reaction.patterns:
+            by_pattern.setdefault(pattern, []).append(position)
+    return by_pattern
+
+
+class ReactionMatcher:
+    """In-memory copy of the reactions collection with compiled pattern automata.
+
+    Patterns added after the last compilation are matched by a small automaton
+    of their own, cheap to rebuild on every addition. Once it holds more than
+    `recent_limit` patterns all patterns are compiled again in a thread and
+    swapped in. The collection is polled for documents appended by other
+    processes and read whole again only when its size doesn't add up, i.e.
+    documents were removed or inserted out of `_id` order.
+    """
+
+    def __init__(self, recent_limit=256, loop=None):
+        self.recent_limit = recent_limit
+        self.loop = loop or asyncio.get_event_loop()
+        self.reactions = []
+        self.by_pattern = OrderedDict()
+        self.automaton = PatternAutomaton()
+        # patterns of `by_pattern` past `compiled` are in the recent automaton only
+        self.compiled = 0
+        self.recent = PatternAutomaton()
+        self.ids = set()
+        self.last_id = None
+        self._compiling = None
+
+    def __len__(self):
+        return len(self.reactions)
+
+    def _remember(self, document_id):
+        self.ids.add(document_id)
+        if isinstance(document_id, ObjectId) and (self.last_id is None or document_id > self.last_id):
+            self.last_id = document_id
+
+    def add(self, reaction):
+        self._remember(reaction.id)
+        position = len(self.reactions)
+        self.reactions.append(reaction)
+        for pattern in reaction.patterns:
+            positions = self.by_pattern.get(pattern)
+            if positions is None:
+                positions = self.by_pattern[pattern] = []
+                self.recent.add(pattern)
+            positions.append(position)
+
+        if len(self.by_pattern) - self.compiled > self.recent_limit and self._compiling is None:
+            self._compiling = asyncio.ensure_future(self.compile(), loop=self.loop)
+
+    def match(self, text):
+        text = text.lower()
+        positions = [position
+                     for pattern in self.automaton.search(text) | self.recent.search(text)
+                     for position in self.by_pattern[pattern]]
+        if not positions:
+            return None
+        # the latest stored reaction wins, as in sequential collection scan
+        return self.reactions[max(positions)]
+
+    async def compile(self):
+        """Compiles all known patterns into the main automaton off the event loop."""
+        try:
+            by_pattern = self.by_pattern
+            patterns = list(by_pattern)
+            automaton = await self.loop.run_in_executor(None, PatternAutomaton, patterns)
+            if by_pattern is not self.by_pattern:
+                # the collection was reloaded meanwhile
+                return
+            self.automaton = automaton
+            self.compiled = len(patterns)
+            # patterns added while compiling
+            self.recent = PatternAutomaton(list(by_pattern)[self.compiled:])
+        finally:
+            self._compiling = None
+
+    async def reload(self, db):
+        reactions, ids = [], set()
+        with mongo_query_time.time(entity=Reaction.collection, operation='load_all'):
+            async for document in db[Reaction.collection].find():
+                ids.add(document['_id'])
+                try:
+                    reactions.append(Reaction.from_dict(**document))
+                except Exception:
+                    log.error("Broken reaction document: %s", document, exc_info=True)
+
+        by_pattern = index_patterns(reactions)
+        # messages are matched against the current automaton until the new one is ready
+        automaton = await self.loop.run_in_executor(None, PatternAutomaton, list(by_pattern))
+
+        self.reactions = reactions
+        self.by_pattern = by_pattern
+        self.automaton = automaton
+        self.compiled = len(by_pattern)
+        self.recent = PatternAutomaton()
+        self.ids = set()
+        self.last_id = None
+        for document_id in ids:
+            self._remember(document_id)
+        log.debug("Loaded %d reactions", len(self.reactions))
+
+    @inject.params(db=AsyncIOMotorDatabase)
+    async def load(self, db=None):
+        """Picks up reactions stored by other processes since the last call."""
+        if not self.ids:
+            await self.reload(db)
+            return
+
+        collection = db[Reaction.collection]
+        query = {} if self.last_id is None else {'_id': {'$gt': self.last_id}}
+        with mongo_query_time.time(entity=Reaction.collection, operation='load_new'):
+            documents = [document async for document in collection.find(query).sort('_id', ASCENDING)
+                         if document['_id'] not in self.ids]
+        for document in documents:
+            self._remember(document['_id'])
+            try:
+                self.add(Reaction.from_dict(**document))
+            except Exception:
+                log.error("Broken reaction document: %s", document, exc_info=True)
+
+        with mongo_query_time.time(entity=Reaction.collection, operation='count'):
+            stored = await collection.count()
+        if stored != len(self.ids):
+            log.info("Reactions were removed or inserted out of order, %d stored and %d known", stored, len(self.ids))
+            await self.reload(db)
+        elif documents:
+            log.debug("Loaded %d new reactions", len(documents))
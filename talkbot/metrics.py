@@ -0,0 +1,121 @@
+import bisect
+import time
+
+from contextlib import contextmanager
+
+
+REGISTRY = []
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def collect(self):
+        return self.values
+
+    def samples(self):
+        """Yields `(suffix, labels, value)` of every series of the metric."""
+        for key, value in sorted(self.collect().items()):
+            yield '', dict(zip(self.labelnames, key)), value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None, registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.function = function
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def collect(self):
+        if self.function is not None:
+            return {(): self.function()}
+        return self.values
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # per bucket counts, +Inf bucket, sum
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', dict(labels, le=format_value(bound)), cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, cumulative
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render(registry=REGISTRY):
+    """Renders metrics of `registry` in Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        lines.append('# HELP %s %s' % (metric.name, metric.documentation.replace('\n', ' ')))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for suffix, labels, value in metric.samples():
+            if labels:
+                pairs = ','.join('%s="%s"' % (name, escape_label(label)) for name, label in labels.items())
+                lines.append('%s%s{%s} %s' % (metric.name, suffix, pairs, format_value(value)))
+            else:
+                lines.append('%s%s %s' % (metric.name, suffix, format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+mongo_query_time = Histogram('talkbot_mongo_query_seconds', "MongoDB operation latency",
+                             ['entity', 'operation'])
@@ -0,0 +1,139 @@
+import asyncio
+import random
+import time
+
+from collections import deque
+
+import aiohttp
+
+from .logger import log
+from .utils import ApiError
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=1, loop=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.loop = loop
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate, loop=self.loop)
+
+
+class OutboundDispatcher:
+    """Background delivery of outgoing API calls within Telegram flood limits.
+
+    Calls are queued per chat and delivered in order by a task living while
+    the chat has pending calls. Every call takes a token from the chat bucket
+    and from the global one. Chat buckets hold up to `chat_burst` tokens, so
+    a reply of a few messages goes out at once and only floods are spread.
+    Failed calls are retried after `retry_after` when Telegram provides it,
+    with jittered exponential backoff otherwise.
+    """
+
+    def __init__(self, send, rate=30, chat_rate=1, group_rate=20 / 60, chat_burst=3, retries=5, backoff=0.5,
+                 max_backoff=30, loop=None):
+        self.send = send
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.loop = loop or asyncio.get_event_loop()
+        self.bucket = TokenBucket(rate, capacity=rate, loop=self.loop)
+        self.chat_buckets = {}
+        self.queues = {}
+        self.tasks = {}
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def submit(self, method, payload):
+        chat_id = payload['chat_id']
+        self.queues.setdefault(chat_id, deque()).append((method, payload))
+        if chat_id not in self.tasks:
+            self.tasks[chat_id] = self.loop.create_task(self._drain(chat_id))
+
+    def _get_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # negative ids are groups and channels with lower limits
+            rate = self.group_rate if int(chat_id) < 0 else self.chat_rate
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, capacity=self.chat_burst, loop=self.loop)
+        return bucket
+
+    async def _drain(self, chat_id):
+        queue = self.queues[chat_id]
+        bucket = self._get_bucket(chat_id)
+        try:
+            while queue:
+                method, payload = queue[0]
+                await bucket.acquire()
+                await self.bucket.acquire()
+                try:
+                    await self._deliver(method, payload)
+                except Exception:
+                    log.error("Failed to deliver %s to %s", method, chat_id, exc_info=True)
+                queue.popleft()
+        finally:
+            del self.tasks[chat_id]
+            if not queue:
+                del self.queues[chat_id]
+            if bucket.full:
+                self.chat_buckets.pop(chat_id, None)
+
+    def _get_backoff(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    async def _deliver(self, method, payload):
+        for attempt in range(self.retries):
+            try:
+                return await self.send(method, payload)
+            except ApiError as ex:
+                if ex.retry_after:
+                    delay = ex.retry_after
+                elif ex.error_code >= 500:
+                    delay = self._get_backoff(attempt)
+                else:
+                    log.error("%s to %s failed permanently: %s", method, payload['chat_id'], ex)
+                    return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                log.warning("%s to %s failed: %s", method, payload['chat_id'], ex)
+                delay = self._get_backoff(attempt)
+
+            log.info("Retrying %s to %s in %.2f seconds", method, payload['chat_id'], delay)
+            await asyncio.sleep(delay, loop=self.loop)
+
+        log.error("Gave up on %s to %s after %d attempts", method, payload['chat_id'], self.retries)
+
+    async def stop(self, timeout):
+        """Waits up to `timeout` seconds for pending calls and cancels the rest."""
+        tasks = list(self.tasks.values())
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=timeout, loop=self.loop)
+        if pending:
+            log.warning("Dropping %d outgoing calls", len(self))
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, loop=self.loop, return_exceptions=True)
@@ -0,0 +1,117 @@
+import asyncio
+import cProfile
+import os
+import time
+import tracemalloc
+
+from .logger import log
+
+
+class Profiler:
+    """On-demand profiling of a live process.
+
+    `start` enables cProfile for the next `updates` processed by `target`
+    and/or for `seconds`, `snapshot` writes a tracemalloc snapshot. Results
+    are dumped into `directory`. While profiling is off `target.handler` is
+    left untouched and nothing is traced.
+
+    Images are hashed in the processes of `fingerprinter`, which the profile
+    of this process doesn't see. They are profiled along and every worker
+    dumps its stats to `<profile>-worker-<pid>.pstats`.
+    """
+
+    def __init__(self, target, directory, fingerprinter=None, loop=None):
+        self.target = target
+        self.directory = directory
+        self.fingerprinter = fingerprinter
+        self.loop = loop or asyncio.get_event_loop()
+        self.profile = None
+        self.path = None
+        self.remaining = None
+        self._handler = None
+        self._timer = None
+
+    @property
+    def active(self):
+        return self.profile is not None
+
+    def _path(self, kind, extension):
+        os.makedirs(self.directory, exist_ok=True)
+        name = '%s-%d-%d.%s' % (kind, os.getpid(), int(time.time() * 1000), extension)
+        return os.path.join(self.directory, name)
+
+    def _counting(self, handler, profile):
+        async def wrapper(update):
+            try:
+                return await handler(update)
+            finally:
+                # updates still in flight from an earlier session don't count
+                if self.profile is profile:
+                    self.remaining -= 1
+                    if self.remaining <= 0:
+                        self.stop()
+        return wrapper
+
+    def start(self, updates=None, seconds=None):
+        """Starts profiling, returns False if it is already running."""
+        if self.active:
+            return False
+
+        self.profile = cProfile.Profile()
+        self.path = self._path('cprofile', 'pstats')
+        if self.fingerprinter is not None:
+            self.fingerprinter.profile_prefix = os.path.splitext(self.path)[0]
+        if updates:
+            self.remaining = updates
+            self._handler = self.target.handler
+            self.target.handler = self._counting(self._handler, self.profile)
+        if seconds:
+            self._timer = self.loop.call_later(seconds, self.stop)
+
+        self.profile.enable()
+        log.info("Profiling started for %s updates, %s seconds", updates or '-', seconds or '-')
+        return True
+
+    def stop(self):
+        """Stops profiling and returns the path of dumped stats."""
+        if not self.active:
+            return None
+        profile, self.profile = self.profile, None
+        profile.disable()
+        if self.fingerprinter is not None:
+            self.fingerprinter.profile_prefix = None
+
+        if self._handler is not None:
+            self.target.handler, self._handler = self._handler, None
+        self.remaining = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        path, self.path = self.path, None
+        profile.dump_stats(path)
+        log.info("Profile saved to %s", path)
+        return path
+
+    def snapshot(self, frames=25):
+        """Writes a tracemalloc snapshot, tracing is started by the first call."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            log.info("Memory tracing started")
+
+        path = self._path('tracemalloc', 'snapshot')
+        tracemalloc.take_snapshot().dump(path)
+        log.info("Memory snapshot saved to %s", path)
+        return path
+
+    def stop_tracing(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            log.info("Memory tracing stopped")
+
+    def toggle(self, seconds):
+        """Signal handler friendly start or stop of profiling."""
+        if self.active:
+            self.stop()
+        else:
+            self.start(seconds=seconds)
@@ -1,23 +1,37 @@
 import asyncio
 
+from concurrent.futures.process import BrokenProcessPool
+
 import inject
 import numpy
-import pandas as pd
 
-from PIL import Image
-from imagehash import hex_to_hash, ImageHash
+from imagehash import hex_to_hash
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from sklearn.ensemble import GradientBoostingClassifier
 
 from . import commands
-from .entities import Reaction, ImageFinger, Config
+from .entities import ImageFinger, Config
+from .fingerprinting import FingerprintCache, FingerprintService, FingerprintQueueFull, fingerprints_rejected
+from .hamming import FingerprintIndex, hamming_distances
 from .logger import log
-from .utils import calc_scores, HASH_SIZE, get_diff_vector
+from .matcher import ReactionMatcher
+from .metrics import Counter, Histogram
+from .utils import HASH_SIZE, DuplicateCascade, FileTooLarge, select_photo_size
+
+
+step_time = Histogram('talkbot_reactor_step_seconds', "Time spent in a message processing step", ['step'])
+inference_time = Histogram('talkbot_classifier_seconds', "Duplicate classifier inference time")
+decisions = Counter('talkbot_duplicate_decisions_total', "Compared pairs by the tier deciding them", ['tier'])
 
 
 class MessageReactor:   # TODO: add tests
     config = inject.attr(Config)
     image_model = inject.attr(GradientBoostingClassifier)
+    cascade = inject.attr(DuplicateCascade)
+    reactions = inject.attr(ReactionMatcher)
+    fingerprints = inject.attr(FingerprintIndex)
+    fingerprinter = inject.attr(FingerprintService)
+    fingerprint_cache = inject.attr(FingerprintCache)
 
     next_step = None
 
@@ -79,13 +93,7 @@ class MessageReactor:   # TODO: add tests
             self.next_step = self.check_repetitions
             return True
 
-        found = None
-        # TODO: optimize it
-        async for reaction in Reaction.find():
-            r = Reaction.from_dict(**reaction)
-            for pattern in r.patterns:
-                if pattern in self.message_text.lower():
-                    found = r
+        found = self.reactions.match(self.message_text)
 
         # short circuit
         if not found or found.on_hold:
@@ -105,20 +113,63 @@ class MessageReactor:   # TODO: add tests
         return self
 
     async def __anext__(self):
-        proceed = await self.next_step(self.message)
+        with step_time.time(step=self.next_step.__name__):
+            proceed = await self.next_step(self.message)
         if proceed:
             return proceed
         else:
             raise StopAsyncIteration
 
+    def find_duplicate(self, packed, candidates):
+        if not candidates:
+            return None
+
+        # feature columns follow FEATURES order both in packed hashes and the model
+        distances = hamming_distances(packed, numpy.stack([finger.packed for finger in candidates]))
+        accepted, rejected, ambiguous = self.cascade.split(distances)
+        decisions.inc(int(accepted.sum()), tier='accept')
+        decisions.inc(int(rejected.sum()), tier='reject')
+        decisions.inc(int(ambiguous.sum()), tier='classifier')
+
+        dup_probs = accepted.astype(numpy.float64)
+        if ambiguous.any():
+            with inference_time.time():
+                class_probs = self.image_model.predict_proba(distances[ambiguous])
+            dup_probs[ambiguous] = class_probs[:, list(self.image_model.classes_).index(True)]
+        log.debug("Probs: %s", dup_probs)
+
+        best = int(dup_probs.argmax())
+        if dup_probs[best] > 0.5:
+            return candidates[best], dup_probs[best]
+        return None
+
+    async def fetch_fingerprint(self, file_id):
+        # no point in downloading what can't be hashed now
+        if self.fingerprinter.full():
+            fingerprints_rejected.inc()
+            log.warning("Skipping photo: fingerprinting queue is full")
+            return None
+
+        file_info = await self.bot.get_file(file_id)
+        if not file_info:
+            return None
+
+        try:
+            data = await self.bot.download_file(file_info['file_path'])
+            return await self.fingerprinter.fingerprint(data)
+        except (FileTooLarge, FingerprintQueueFull, BrokenProcessPool) as ex:
+            log.warning("Skipping photo: %s", ex)
+            return None
+
     async def check_repetitions(self, message):
         if 'photo' not in message:
             return
 
-        images_by_size = sorted(message['photo'], key=lambda img: img['file_size'], reverse=True)
-        image_info = images_by_size[0]
+        image_info = select_photo_size(message['photo'], self.config.photo_min_side)
 
-        finger = await ImageFinger.find_one({'chat_id': self.chat_id, 'file_id': image_info['file_id']})
+        # any size of the photo may be stored depending on the threshold at that time
+        file_ids = [img['file_id'] for img in message['photo']]
+        finger = await self.fingerprints.find_file(self.chat_id, file_ids)
         log.debug("Fingerprint: %s", finger)
 
         if finger:
@@ -128,46 +179,50 @@ class MessageReactor:   # TODO: add tests
             }
             return
 
-        data = await self.bot.get_file(image_info['file_id'])
-        buffer = await self.bot.download_file(data['file_path'])
-
-        img = Image.open(buffer)
-        scores = calc_scores(img)
-        new_img = dict(scores)
-
-        async for finger in ImageFinger.find({'chat_id': self.chat_id}):
-            stored_img = dict((name, ImageHash(numpy.asarray(bytes_list, dtype=numpy.bool_)))
-                       for name, bytes_list in finger['vectors'])
-            diff = get_diff_vector(new_img, stored_img)
-
-            vector = pd.DataFrame.from_dict([diff])
-            # duplicate = finger
-            predicted = self.image_model.predict(vector)
-            class_probs = self.image_model.predict_proba(vector)
-            log.debug("Predict res: %s", predicted[0])
-            log.debug("Probs: %s", class_probs)
-
-            p_class = predicted[0]
-            class_prob = class_probs[0][int(p_class)]
-            if p_class:
-                await self.bot.send_message({
-                    'reply_to_message_id': self.message['message_id'],
-                    'text': "Баян (%d%%)" % int(class_prob * 100),
-                    'chat_id': self.chat_id
-                })
-                await self.bot.send_message({
-                    'reply_to_message_id': finger['message']['message_id'],
-                    'text': "Пруф",
-                    'chat_id': self.chat_id
-                })
+        # the same file forwarded or posted in another chat keeps its unique id
+        unique_id = image_info.get('file_unique_id')
+        packed = await self.fingerprint_cache.get(unique_id) if unique_id else None
+        if packed is None:
+            packed = await self.fetch_fingerprint(image_info['file_id'])
+            if packed is None:
                 return
+            if unique_id:
+                await self.fingerprint_cache.put(unique_id, packed)
+
+        candidates = await self.fingerprints.candidates(self.chat_id, packed)
+        log.debug("Candidates to compare: %d", len(candidates))
+
+        duplicate = self.find_duplicate(packed, candidates)
+        if duplicate:
+            finger, class_prob = duplicate
+            self.bot.send_message({
+                'reply_to_message_id': self.message['message_id'],
+                'text': "Баян (%d%%)" % int(class_prob * 100),
+                'chat_id': self.chat_id
+            })
+            self.bot.send_message({
+                'reply_to_message_id': finger.message_id,
+                'text': "Пруф",
+                'chat_id': self.chat_id
+            })
+            return
 
-        fp = await ImageFinger.create({
+        fp = await ImageFinger.create(dict(ImageFinger.message_fields(message), **{
             'id': None,
-            'vectors': list([name, img_hash.hash.tolist()] for name, img_hash in scores),
-            'message': message,
+            'version': ImageFinger.VERSION,
+            'vectors': ImageFinger.encode_vectors(packed),
             'file_id': image_info['file_id'],
             'chat_id': self.chat_id
-        })
+        }))
         log.info("New image saved for future: %s", fp.id)
 
+        if self.fingerprints.needs_trim(self.chat_id):
+            asyncio.ensure_future(self.trim_fingerprints())
+
+    async def trim_fingerprints(self):
+        try:
+            deleted = await self.fingerprints.trim(self.chat_id)
+            log.info("Trimmed %d fingerprints of chat %s", deleted, self.chat_id)
+        except Exception:
+            log.error("Failed to trim fingerprints of chat %s", self.chat_id, exc_info=True)
+
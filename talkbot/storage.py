@@ -1,10 +1,23 @@
 import inject
 import motor
 
-from talkbot.entities import Config
+from talkbot.entities import Config, Reaction, ImageFinger, FileFingerprint
+from talkbot.logger import log
+
+
+ENTITIES = (Reaction, ImageFinger, FileFingerprint)
 
 
 @inject.params(config=Config)
 def init_database(config=None):
     client = motor.motor_asyncio.AsyncIOMotorClient(config.mongo.uri)
     return client[config.mongo.db]
+
+
+async def ensure_indexes(entities=ENTITIES):
+    created = []
+    for entity in entities:
+        names = await entity.ensure_indexes()
+        log.info("Indexes of '%s': %s", entity.collection, ", ".join(names) or "none")
+        created.extend(names)
+    return created
@@ -5,14 +5,17 @@ import trafaret as t
 
 class FilePath(t.String):   # TODO: add tests
 
-    def __init__(self):
-        super().__init__(regex=r'^(/)?([^/\0]+(/)?)+$', min_length=1)
+    def __init__(self, allow_blank=False):
+        super().__init__(allow_blank=allow_blank, regex=r'^(/)?([^/\0]+(/)?)+$',
+                         min_length=None if allow_blank else 1)
 
     def __repr__(self):
-        return '<File>'
+        return '<File(blank)>' if self.allow_blank else '<File>'
 
     def check_and_return(self, value):
         val = super().check_and_return(value)
+        if not val:
+            return val
         val = self.converter(val)
 
         if not os.path.exists(val):
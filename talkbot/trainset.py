@@ -9,13 +9,12 @@
 
 import itertools
 import multiprocessing
-import operator
 import os
 
-from functools import reduce
 from multiprocessing.pool import Pool
 
 import click
+import numpy
 
 import pandas as pd
 import time
@@ -24,10 +23,15 @@ from PIL import Image
 from imagehash import hex_to_hash
 from sklearn.ensemble import GradientBoostingClassifier
 
-from talkbot.utils import calc_scores, get_diff_vector, ALG, prepare_image, HASH_SIZE
+from talkbot.fingerprinting import fingerprint
+from talkbot.hamming import ChatFingerprints, IndexedFinger, hamming_distances
+from talkbot.utils import calc_scores, get_diff_vector, ALG, prepare_image, HASH_SIZE, FEATURES, fit_model, save_model
+from talkbot.utils import fit_cascade, CASCADE_PRECISION
 
 BASEDIR = './data'
 TRAINDIR = os.path.join(BASEDIR, 'train')
+HASH_CACHE = os.path.join(BASEDIR, 'hashes.npz')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
 RESHAPE = (512, 512)
 pool_size = multiprocessing.cpu_count()
 
@@ -37,61 +41,209 @@ def _main():
     pass
 
 
-def save_training_sampl(image_path, idx, sample_options):
+def sample_path(idx, sample_options):
+    return os.path.join(TRAINDIR, str(idx) + '_%s_%s_%s_%s' % sample_options + '.png')
+
+
+def save_training_samples(task):
+    """Decodes a source image once and saves its missing ALG variants, runs in a worker."""
+    idx, image_path = task
+    missing = [options for options in ALG if not os.path.exists(sample_path(idx, options))]
+    if not missing:
+        return 0, len(ALG)
+
     try:
         image_obj = Image.open(image_path)
-        v, h, fit_image = sample_options[1:]
-        name = '_%s_%s_%s_%s' % sample_options
-        var_img = prepare_image(
-            image_obj,
-            crop_width_perc=v,
-            crop_height_perc=h,
-            fit_image=fit_image,
-            grayscale=False
-        )
-        var_img.save(os.path.join(TRAINDIR, str(idx) + name + '.png'), 'PNG')
-
+        image_obj.load()
+        for sample_options in missing:
+            v, h, fit_image = sample_options[1:]
+            var_img = prepare_image(
+                image_obj,
+                crop_width_perc=v,
+                crop_height_perc=h,
+                fit_image=fit_image,
+                grayscale=False
+            )
+            # a run killed mid-write must not leave a truncated sample that resuming would skip
+            path = sample_path(idx, sample_options)
+            var_img.save(path + '.part', 'PNG')
+            os.replace(path + '.part', path)
     except OSError as ex:
         print(ex)
+        return 0, 0
+    return len(missing), len(ALG) - len(missing)
+
+
+def hash_training_image(name):
+    with open(os.path.join(TRAINDIR, name), 'rb') as image_file:
+        return name, fingerprint(image_file.read())
+
+
+def file_stamp(name):
+    stat = os.stat(os.path.join(TRAINDIR, name))
+    return '%s:%d:%d' % (name, stat.st_mtime_ns, stat.st_size)
+
+
+def save_hashes(cache_path, stamps, packed):
+    # replaced at once, an interrupted write must not lose the hashes saved before
+    part = cache_path + '.part.npz'
+    numpy.savez(part, stamps=numpy.array(stamps), packed=packed)
+    os.replace(part, cache_path)
+
+
+def load_hashes(names, cache_path, pool, save_every=1000):
+    """Packed hashes of `names` in the same order, only new or changed files are hashed.
+
+    Hashes are saved to the cache every `save_every` images, so an
+    interrupted run resumes where it stopped.
+    """
+    cached = {}
+    if os.path.exists(cache_path):
+        with numpy.load(cache_path) as cache:
+            cached = dict(zip(cache['stamps'], cache['packed']))
+
+    stamps = [file_stamp(name) for name in names]
+    missing = [name for name, stamp in zip(names, stamps) if stamp not in cached]
+    click.echo("Hashing %d of %d images" % (len(missing), len(names)))
+    for done, (name, packed) in enumerate(pool.imap_unordered(hash_training_image, missing, chunksize=16), 1):
+        cached[file_stamp(name)] = packed
+        if done % save_every == 0 and done < len(missing):
+            save_hashes(cache_path, list(cached), numpy.stack(list(cached.values())))
+            click.echo("Hashed %d images" % done)
+
+    packed = numpy.stack([cached[stamp] for stamp in stamps])
+    if missing:
+        save_hashes(cache_path, stamps, packed)
+    return packed
+
 
+def positive_pairs(groups):
+    for members in groups.values():
+        for left, right in itertools.combinations(members, 2):
+            yield left, right
 
-def get_images_diff_vectors(image_pair):
-    img_objs = map(lambda i: Image.open(os.path.join(TRAINDIR, i)), image_pair)
-    scores = map(dict,
-                 map(calc_scores, img_objs))
 
-    names = [i.split('_')[0] for i in image_pair]
-    is_dup = reduce(operator.eq, names)
+def random_negative_pairs(labels, count, random):
+    """`count` pairs per image with a random image of another source."""
+    size = len(labels)
+    for left in range(size):
+        for right in random.randint(0, size, count):
+            if labels[left] != labels[right]:
+                yield left, int(right)
 
-    vector = get_diff_vector(*scores)
-    vector['d'] = is_dup
-    return vector
+
+def hard_negative_pairs(packed, labels, count, radius):
+    """Up to `count` closest pairs per image among candidates found within `radius`.
+
+    Candidates come from the same multi-index lookup the bot uses, so these
+    are the pairs the classifier actually has to tell apart.
+    """
+    index = ChatFingerprints(radius)
+    for matrix in packed:
+        index.add(IndexedFinger(message_id=None, file_id=None, packed=matrix))
+
+    for left, matrix in enumerate(packed):
+        others = [finger.row for finger in index.candidates(matrix)
+                  if finger.row > left and labels[finger.row] != labels[left]]
+        if not others:
+            continue
+        totals = hamming_distances(matrix, packed[others]).sum(axis=1)
+        for position in numpy.argsort(totals, kind='mergesort')[:count]:
+            yield left, others[position]
+
+
+def chunked(pairs, size):
+    while True:
+        chunk = list(itertools.islice(pairs, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def write_pair_features(out, packed, labels, pairs, chunk_size):
+    """Streams distances of `pairs` to `out` CSV chunk by chunk, returns rows written."""
+    written = 0
+    for chunk in chunked(pairs, chunk_size):
+        left, right = numpy.array(chunk).T
+        df = pd.DataFrame(hamming_distances(packed[left], packed[right]), columns=FEATURES)
+        df['d'] = labels[left] == labels[right]
+        df.to_csv(out, index=False, header=not written, mode='w' if not written else 'a')
+        written += len(df)
+        click.echo("Written %d pairs" % written)
+    return written
 
 
 @_main.command()
-def gen_set():
-    img_files = [files for _, _, files in os.walk(BASEDIR)]
+@click.option('--chunk-size', default=8, type=click.IntRange(min=1))
+@click.option('--report-every', default=100, type=click.IntRange(min=1))
+def gen_set(chunk_size, report_every):
+    start = time.time()
+    # sorted, so indexes and output names are stable between runs
+    img_files = sorted(name for name in os.listdir(BASEDIR) if name.lower().endswith(IMAGE_EXTENSIONS))
+    tasks = [(idx, os.path.join(BASEDIR, image)) for idx, image in enumerate(img_files)]
+    os.makedirs(TRAINDIR, exist_ok=True)
 
+    saved = skipped = 0
     with Pool(processes=pool_size) as pool:
-        for idx, image in enumerate(img_files):
-            image_path = os.path.join(BASEDIR, image)
-            for sample_options in ALG:
-                pool.apply(save_training_sampl, (image_path, idx, sample_options))
+        results = pool.imap_unordered(save_training_samples, tasks, chunksize=chunk_size)
+        for done, (written, existing) in enumerate(results, 1):
+            saved += written
+            skipped += existing
+            if done % report_every == 0 or done == len(tasks):
+                elapsed = time.time() - start
+                click.echo("%d/%d images, %d samples saved, %d skipped, %.1f images/s" % (
+                    done, len(tasks), saved, skipped, done / elapsed))
 
 
 @_main.command()
 @click.option('--out', default='sample.csv')
-def store_training(out):
+@click.option('--cache', default=HASH_CACHE, help="Hashes of already processed images.")
+@click.option('--all-pairs', is_flag=True, help="Every pair of images, quadratic in the number of images.")
+@click.option('--negatives', default=5, type=click.IntRange(min=0), help="Random negative pairs per image.")
+@click.option('--hard-negatives', default=5, type=click.IntRange(min=0), help="Closest negative pairs per image.")
+@click.option('--radius', default=24, type=click.IntRange(min=0), help="Hard negatives search radius in bits.")
+@click.option('--chunk-size', default=100000, type=click.IntRange(min=1))
+@click.option('--save-every', default=1000, type=click.IntRange(min=1), help="Images hashed between cache saves.")
+@click.option('--seed', default=0)
+def store_training(out, cache, all_pairs, negatives, hard_negatives, radius, chunk_size, save_every, seed):
     start = time.time()
-    img_files = [files for _, _, files in os.walk(TRAINDIR)]
-    train_combs = itertools.combinations(img_files, 2)
+    names = sorted(name for name in os.listdir(TRAINDIR) if name.endswith('.png'))
+    # samples are named after the index of their source image
+    labels = numpy.array([name.split('_')[0] for name in names])
 
     with Pool(processes=pool_size) as pool:
-        vectors = pool.map(get_images_diff_vectors, train_combs)
-    df = pd.DataFrame(vectors)
-    df.to_csv(out, index=False)
+        packed = load_hashes(names, cache, pool, save_every)
+
+    if all_pairs:
+        pairs = itertools.combinations(range(len(names)), 2)
+    else:
+        groups = {}
+        for row, label in enumerate(labels):
+            groups.setdefault(label, []).append(row)
+        pairs = itertools.chain(
+            positive_pairs(groups),
+            random_negative_pairs(labels, negatives, numpy.random.RandomState(seed)),
+            hard_negative_pairs(packed, labels, hard_negatives, radius) if hard_negatives else (),
+        )
+
+    written = write_pair_features(out, packed, labels, pairs, chunk_size)
+    finished = time.time() - start
+    click.echo("%d pairs of %d images stored in %s seconds" % (written, len(names), finished))
+
+
+@_main.command()
+@click.option('--input', default='sample.csv')
+@click.option('--out', default='model.pkl')
+@click.option('--precision', default=CASCADE_PRECISION, help="Required precision of cascade decisions.")
+def build_model(input, out, precision):
+    start = time.time()
+    l_model = fit_model(input)
+    cascade = fit_cascade(input, precision)
+    artifact = save_model(l_model, out, input, cascade)
     finished = time.time() - start
-    click.echo("Finised in %s seconds" % finished)
+    click.echo("Model for %s (sample %s) saved to %s in %s seconds" % (artifact['alg'], artifact['checksum'],
+                                                                       out, finished))
+    click.echo("Cascade: %s" % cascade)
 
 
 @_main.command()
@@ -103,7 +255,7 @@ def train(input):
 
     l_model = GradientBoostingClassifier()
     l_model = l_model.fit(
-        df[df.columns.difference(['d'])],
+        df[list(FEATURES)],
         df['d']
     )
     s = [["crop_0_0_True", "bf0fff33feff01102df52f0035010700ff243fcf9fc70080dfffffff00000000"],
@@ -124,7 +276,7 @@ def train(input):
     vector = get_diff_vector(list(scores)[0], scores2)
 
     print(vector)
-    df2 = pd.DataFrame.from_dict([vector])
+    df2 = pd.DataFrame.from_dict([vector])[list(FEATURES)]
     # print(df2.values)
 
     p_class = l_model.predict(df2)[0]
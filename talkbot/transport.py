@@ -0,0 +1,115 @@
+import asyncio
+import time
+
+import aiohttp
+
+from .logger import log
+from .metrics import Histogram
+from .utils import ApiError, read_limited
+
+
+API_METHODS = ('getUpdates', 'setWebhook', 'deleteWebhook', 'getFile', 'sendMessage', 'sendPhoto')
+
+pool_wait_time = Histogram('talkbot_http_pool_wait_seconds', "Time spent waiting for a pooled connection",
+                           ['pool'])
+request_time = Histogram('talkbot_http_request_seconds', "Telegram API request latency", ['endpoint'])
+download_size = Histogram('talkbot_download_bytes', "Size of downloaded files",
+                          buckets=[2 ** power for power in range(12, 24)])
+
+
+class ConnectionPool:
+    """Client session over a connector of `limit` keep-alive connections.
+
+    Requests wait for a free connection on a semaphore of the same size, so
+    the time spent in the queue can be measured.
+    """
+
+    def __init__(self, name, limit, keepalive_timeout, loop=None):
+        self.name = name
+        self.connector = aiohttp.TCPConnector(limit=limit, keepalive_timeout=keepalive_timeout,
+                                              use_dns_cache=True, loop=loop)
+        self.session = aiohttp.ClientSession(connector=self.connector, loop=loop)
+        self.slots = asyncio.Semaphore(limit, loop=loop)
+
+    async def acquire(self):
+        started = time.perf_counter()
+        await self.slots.acquire()
+        pool_wait_time.observe(time.perf_counter() - started, pool=self.name)
+
+    def release(self):
+        self.slots.release()
+
+    async def close(self):
+        await self.session.close()
+
+
+class ApiClient:
+    """Telegram Bot API transport with separate pools for API calls and file downloads."""
+    BASE_URI = "https://api.telegram.org/bot{token}/"
+    FILE_URI = "https://api.telegram.org/file/bot{token}/"
+
+    def __init__(self, token, api_pool, file_pool, base_uri=BASE_URI, file_uri=FILE_URI):
+        self.api_pool = api_pool
+        self.file_pool = file_pool
+        self.base_uri = base_uri.format(token=token)
+        self.file_uri = file_uri.format(token=token)
+        self.endpoints = dict((method, self.base_uri + method) for method in API_METHODS)
+
+    @classmethod
+    def from_config(cls, token, http_config, loop=None):
+        return cls(
+            token,
+            ConnectionPool('api', http_config.api_connections, http_config.keepalive_timeout, loop=loop),
+            ConnectionPool('file', http_config.file_connections, http_config.keepalive_timeout, loop=loop),
+            base_uri=http_config.api_uri,
+            file_uri=http_config.file_uri,
+        )
+
+    def get_uri(self, method):
+        uri = self.endpoints.get(method)
+        if uri is None:
+            uri = self.endpoints[method] = self.base_uri + method
+        return uri
+
+    @staticmethod
+    async def _raise_for_response(response):
+        r_data = await response.json()
+        if r_data['ok']:
+            return r_data['result']
+        else:
+            msg = "{error_code} | {description} ".format(**r_data)
+            log.error(msg)
+            raise ApiError(r_data['error_code'], r_data['description'], r_data.get('parameters'))
+
+    async def call(self, method, payload=None, params=None):
+        """Calls API `method` with form `payload` or GET `params`, returns its result."""
+        await self.api_pool.acquire()
+        started = time.perf_counter()
+        try:
+            if payload is None:
+                request = self.api_pool.session.get(self.get_uri(method), params=params)
+            else:
+                request = self.api_pool.session.post(self.get_uri(method), data=payload)
+            async with request as resp:
+                return await self._raise_for_response(resp)
+        finally:
+            request_time.observe(time.perf_counter() - started, endpoint=method)
+            self.api_pool.release()
+
+    async def download(self, file_path, limit):
+        """Streams file at `file_path` of at most `limit` bytes, returns its content."""
+        await self.file_pool.acquire()
+        started = time.perf_counter()
+        try:
+            async with self.file_pool.session.get(self.file_uri + file_path) as resp:
+                resp.raise_for_status()
+                length = resp.headers.get(aiohttp.hdrs.CONTENT_LENGTH)
+                data = await read_limited(resp.content, limit, int(length) if length else None)
+                download_size.observe(len(data))
+                return data
+        finally:
+            request_time.observe(time.perf_counter() - started, endpoint='file')
+            self.file_pool.release()
+
+    async def close(self):
+        await asyncio.gather(self.api_pool.close(), self.file_pool.close())
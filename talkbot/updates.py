@@ -0,0 +1,264 @@
+import asyncio
+import json
+import time
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import trafaret as t
+
+from .logger import log
+from .metrics import Counter, Gauge, Histogram
+from .utils import ApiError
+
+
+def get_chat_id(update):
+    message = update.get('message') or update.get('channel_post') or {}
+    return message.get('chat', {}).get('id', 0)
+
+
+update_trafaret = t.Dict({
+    'update_id': t.Int,
+}).allow_extra('*')
+
+queue_depth = Gauge('talkbot_update_queue_depth', "Updates waiting to be processed")
+queue_wait_time = Histogram('talkbot_update_queue_wait_seconds', "Time updates spent in the queue")
+updates_dropped = Counter('talkbot_updates_dropped_total', "Updates shed on queue overflow", ['policy'])
+
+
+class QueueFull(Exception):
+    pass
+
+
+class UpdateRecorder:
+    """Appends incoming updates to a JSONL file for later replay.
+
+    Every line holds the seconds passed since recording started and the
+    update. Occurrences of `secrets` are replaced in all string values.
+    Lines are buffered and written by a background thread once `buffer_size`
+    lines are pending or `flush_interval` seconds passed since the last write.
+    """
+    SCRUBBED = '<scrubbed>'
+
+    def __init__(self, path, secrets=(), buffer_size=100, flush_interval=1.0):
+        self.secrets = [secret for secret in secrets if secret]
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.output = open(path, 'a', encoding='utf-8')
+        self.started = self.flushed = time.monotonic()
+        self.pending = []
+        # a single thread keeps the lines in order
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def scrub(self, value):
+        if isinstance(value, dict):
+            return dict((key, self.scrub(item)) for key, item in value.items())
+        if isinstance(value, list):
+            return [self.scrub(item) for item in value]
+        if isinstance(value, str):
+            for secret in self.secrets:
+                value = value.replace(secret, self.SCRUBBED)
+        return value
+
+    def _write(self, lines):
+        self.output.write(''.join(lines))
+        self.output.flush()
+
+    def record(self, update):
+        now = time.monotonic()
+        line = {'offset': round(now - self.started, 6), 'update': self.scrub(update)}
+        self.pending.append(json.dumps(line, ensure_ascii=False) + '\n')
+        if len(self.pending) >= self.buffer_size or now - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            lines, self.pending = self.pending, []
+            self.executor.submit(self._write, lines)
+        self.flushed = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+        self.output.close()
+
+
+class UpdateQueue:
+    """Bounded in-process queue of incoming updates.
+
+    Updates wait in per-chat queues drained by a pool of `workers` tasks. A
+    chat is taken by one worker at a time, so updates of a chat are handled
+    one by one in arrival order, while up to `workers` chats run concurrently
+    and a slow update holds up its own chat only. When `size` updates are
+    pending in total the update is handled according to `overflow`:
+
+    * `reject` – `put` raises QueueFull and Telegram redelivers it later;
+    * `drop_new` – the update is dropped;
+    * `drop_oldest` – the oldest pending update of the chat with most pending
+      updates is dropped.
+    """
+    OVERFLOW_POLICIES = ('reject', 'drop_new', 'drop_oldest')
+
+    def __init__(self, handler, workers, size, overflow='reject', loop=None):
+        assert overflow in self.OVERFLOW_POLICIES
+        self.handler = handler
+        self.workers = workers
+        self.size = size
+        self.loop = loop or asyncio.get_event_loop()
+        self.overflow = overflow
+        # chats with pending updates or handled at the moment
+        self.queues = {}
+        # chats waiting for a worker, each one at most once
+        self.ready = asyncio.Queue(loop=self.loop)
+        self.pending = 0
+        self.handling = 0
+        self.drained = asyncio.Event(loop=self.loop)
+        self.drained.set()
+        self.tasks = []
+
+    def qsize(self):
+        return self.pending
+
+    def start(self):
+        queue_depth.function = self.qsize
+        self.tasks = [self.loop.create_task(self._work()) for _ in range(self.workers)]
+
+    def put(self, update):
+        if self.pending >= self.size:
+            updates_dropped.inc(policy=self.overflow)
+            if self.overflow == 'reject':
+                raise QueueFull("Update %s rejected, queue is full" % update['update_id'])
+            elif self.overflow == 'drop_new':
+                log.warning("Queue is full, dropping update %s", update['update_id'])
+                return
+            busiest = max(self.queues.values(), key=len)
+            _, dropped = busiest.popleft()
+            self.pending -= 1
+            log.warning("Queue is full, dropping update %s", dropped['update_id'])
+
+        chat_id = get_chat_id(update)
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = deque()
+            self.ready.put_nowait(chat_id)
+        queue.append((time.monotonic(), update))
+        self.pending += 1
+        self.drained.clear()
+
+    async def _work(self):
+        while True:
+            chat_id = await self.ready.get()
+            queue = self.queues[chat_id]
+            if not queue:
+                # its updates were dropped on overflow
+                del self.queues[chat_id]
+                continue
+
+            enqueued_at, update = queue.popleft()
+            self.pending -= 1
+            self.handling += 1
+            queue_wait_time.observe(time.monotonic() - enqueued_at)
+            try:
+                await self.handler(update)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.error("Failed to process update %s", update['update_id'], exc_info=True)
+            finally:
+                self.handling -= 1
+                if queue:
+                    # the rest of the chat waits behind chats that are ready already
+                    self.ready.put_nowait(chat_id)
+                else:
+                    del self.queues[chat_id]
+                if not self.pending and not self.handling:
+                    self.drained.set()
+
+    async def join(self):
+        """Waits until every pending update is handled."""
+        await self.drained.wait()
+
+    async def stop(self, timeout):
+        """Waits up to `timeout` seconds for pending updates and stops workers."""
+        try:
+            await asyncio.wait_for(self.join(), timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            log.warning("Pending updates left: %d", self.qsize())
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, loop=self.loop, return_exceptions=True)
+
+
+class UpdatePoller:
+    """Long-polling ingestion of updates with `getUpdates`.
+
+    Every batch is processed concurrently chat by chat, keeping the order of
+    updates within a chat. The offset moves past the batch only after it is
+    processed, so updates of an interrupted batch are delivered again.
+    Telegram forgets updates only on the next request with the new offset,
+    so one more request confirms the last batch on stop.
+    """
+
+    def __init__(self, bot, handler, limit=100, timeout=30, retry_delay=5, loop=None):
+        self.bot = bot
+        self.handler = handler
+        self.limit = limit
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.loop = loop or asyncio.get_event_loop()
+        self.stopped = False
+        self._request = None
+
+    async def _process_chat(self, updates):
+        for update in updates:
+            try:
+                await self.handler(update)
+            except Exception:
+                log.error("Failed to process update %s", update['update_id'], exc_info=True)
+
+    async def process_batch(self, updates):
+        by_chat = OrderedDict()
+        for update in updates:
+            by_chat.setdefault(get_chat_id(update), []).append(update)
+        await asyncio.gather(*(self._process_chat(chat_updates) for chat_updates in by_chat.values()),
+                             loop=self.loop)
+
+    async def confirm(self):
+        try:
+            await self.bot.get_updates(1, 0)
+        except (ApiError, aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            log.error("Failed to confirm processed updates: %s", ex)
+
+    async def run(self):
+        # updates before the offset of the last successful request are forgotten by Telegram
+        confirmed_offset = self.bot.update_offset
+        while not self.stopped:
+            offset = self.bot.update_offset
+            self._request = self.loop.create_task(self.bot.get_updates(self.limit, self.timeout))
+            try:
+                updates = await self._request
+                confirmed_offset = offset
+            except asyncio.CancelledError:
+                if self.stopped:
+                    break
+                raise
+            except (ApiError, aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                log.error("Failed to get updates: %s", ex)
+                await asyncio.sleep(self.retry_delay, loop=self.loop)
+                continue
+
+            if updates:
+                log.debug("Got %d updates", len(updates))
+                await self.process_batch(updates)
+                self.bot.update_offset = max(update['update_id'] for update in updates) + 1
+
+        if self.bot.update_offset != confirmed_offset:
+            await self.confirm()
+
+    def stop(self):
+        """Stops polling, a batch in progress is processed to the end."""
+        self.stopped = True
+        if self._request is not None and not self._request.done():
+            self._request.cancel()
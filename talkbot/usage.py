@@ -0,0 +1,48 @@
+import time
+
+import inject
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+from .metrics import mongo_query_time
+
+
+class UsageLedger:
+    """Write-behind storage of `last_used` timestamps.
+
+    Usage is recorded in memory and answered from there, pending timestamps
+    are flushed to the collection with a single `bulk_write` call.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.last_used = {}
+        self.pending = {}
+
+    def touch(self, document_id, timestamp=None):
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        self.last_used[document_id] = timestamp
+        self.pending[document_id] = timestamp
+
+    def get(self, document_id, default=0):
+        return max(self.last_used.get(document_id, 0), default)
+
+    @inject.params(db=AsyncIOMotorDatabase)
+    async def flush(self, db=None):
+        if not self.pending:
+            return 0
+
+        pending, self.pending = self.pending, {}
+        requests = [UpdateOne({'_id': document_id}, {'$max': {'last_used': timestamp}})
+                    for document_id, timestamp in pending.items()]
+        try:
+            with mongo_query_time.time(entity=self.collection, operation='bulk_write'):
+                await db[self.collection].bulk_write(requests, ordered=False)
+        except Exception:
+            # keep timestamps for the next attempt unless newer ones were recorded
+            for document_id, timestamp in pending.items():
+                self.pending.setdefault(document_id, timestamp)
+            raise
+
+        return len(requests)
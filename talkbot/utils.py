@@ -1,17 +1,24 @@
 import asyncio
+import hashlib
 import os
+import pickle
 import re
 import signal
+import time
+
+from collections import namedtuple
 
 import aiohttp
 import imagehash
 import inject
+import numpy
 import pandas as pd
 
 from PIL import Image, ImageOps
 from aiohttp.log import access_logger
 from sklearn.ensemble import GradientBoostingClassifier
 
+from .logger import log
 
 url_regex = re.compile(
     r'^(?:http|ftp)s?://'  # http:// or https://
@@ -23,6 +30,41 @@ url_regex = re.compile(
     r'(?:/?|[/?]\S+)$', re.IGNORECASE)
 
 
+class FileTooLarge(Exception):
+    pass
+
+
+class ApiError(Exception):
+
+    def __init__(self, error_code, description, parameters=None):
+        super().__init__("{} | {}".format(error_code, description))
+        self.error_code = error_code
+        self.description = description
+        self.retry_after = (parameters or {}).get('retry_after')
+
+
+async def read_limited(stream, limit, length=None):
+    """Reads `stream` chunk by chunk, fails as soon as more than `limit` bytes arrive."""
+    if length is not None and length > limit:
+        raise FileTooLarge("Content length %d exceeds %d bytes" % (length, limit))
+
+    data = bytearray()
+    async for chunk in stream.iter_any():
+        if len(data) + len(chunk) > limit:
+            raise FileTooLarge("Content exceeds %d bytes" % limit)
+        data += chunk
+    return data
+
+
+def select_photo_size(sizes, min_side):
+    """Smallest photo size with both sides not less than `min_side`, the largest one otherwise."""
+    by_area = sorted(sizes, key=lambda img: img['width'] * img['height'])
+    for image_info in by_area:
+        if min(image_info['width'], image_info['height']) >= min_side:
+            return image_info
+    return by_area[-1]
+
+
 def get_user_repr(user):
     return user.get('username', " ".join([user['first_name'], user.get('last_name','')]))
 
@@ -35,6 +77,17 @@ async def fetch_file(url, connector=None):
     return await rv.content.read()
 
 
+async def run_periodically(interval, func, *args, loop=None):
+    while True:
+        await asyncio.sleep(interval, loop=loop)
+        try:
+            await func(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.error("Periodic call of %s failed", func, exc_info=True)
+
+
 def run_app(app, loop, shutdown_timeout=60.0, ssl_context=None, backlog=128):
     pid = os.getppid()
 
@@ -90,6 +143,11 @@ def find_ngrams(input_list, n):
 
 
 RESHAPE = (512, 512)
+# JPEG sources are decoded at the smallest scale still covering this size, smaller drafts drift off the
+# RESHAPE resize of stored fingerprints on large photos
+DRAFT_SIZE = (512, 512)
+# regions with fewer pixels per hash block side are resampled before averaging
+MIN_BLOCK_SIZE = 8
 
 
 HASH_SIZE = 16
@@ -104,6 +162,8 @@ ALG = (
     ('crop', 0.1, 0, False),  # horizontal 10% crop resized to RESHAPE
     ('crop', 0.1, 0.1, False),  # vertical and horizontal 10% crop resized to RESHAPE
 )
+# model features order, the same as hash variants are stored in
+FEATURES = tuple('%s_%s_%s_%s' % item for item in ALG)
 
 
 def prepare_image(img, crop_width_perc=0, crop_height_perc=0, fit_image=True, grayscale=True):
@@ -133,22 +193,74 @@ def prepare_image(img, crop_width_perc=0, crop_height_perc=0, fit_image=True, gr
     return result.resize(RESHAPE, resize_option)
 
 
+def load_grayscale(source_image):
+    """Decodes `source_image` once, at reduced scale when possible, into grayscale."""
+    source_image.draft('L', DRAFT_SIZE)
+    return source_image.convert('L')
+
+
+def crop_box(size, crop_width_perc=0, crop_height_perc=0, fit_image=True):
+    """Box of the `prepare_image` variant before it gets resized to RESHAPE."""
+    width, height = size
+    width_crop_size = int(width * crop_width_perc / 2) if crop_width_perc > 0 else 0
+    height_crop_size = int(height * crop_height_perc / 2) if crop_height_perc > 0 else 0
+    left, top = width_crop_size, height_crop_size
+    right, bottom = width - width_crop_size, height - height_crop_size
+
+    if fit_image:
+        # centered crop to RESHAPE aspect ratio, as ImageOps.fit does
+        crop_width, crop_height = right - left, bottom - top
+        ratio = RESHAPE[0] / RESHAPE[1]
+        fit_width, fit_height = min(crop_width, crop_height * ratio), min(crop_height, crop_width / ratio)
+        left += (crop_width - fit_width) / 2
+        top += (crop_height - fit_height) / 2
+        right, bottom = left + fit_width, top + fit_height
+    return left, top, right, bottom
+
+
+def block_means(pixels, size):
+    """Averages `pixels` over a `size` x `size` grid of blocks."""
+    height, width = pixels.shape
+    rows = numpy.linspace(0, height, size, endpoint=False).astype(int)
+    cols = numpy.linspace(0, width, size, endpoint=False).astype(int)
+    sums = numpy.add.reduceat(numpy.add.reduceat(pixels, rows, axis=0, dtype=numpy.float64), cols, axis=1)
+    counts = numpy.outer(numpy.diff(numpy.append(rows, height)), numpy.diff(numpy.append(cols, width)))
+    return sums / counts
+
+
+def wavelet_hash(pixels, hash_size=HASH_SIZE):
+    """Haar `imagehash.whash` of `pixels` region resized to RESHAPE.
+
+    With the largest LL coefficient removed the Haar approximation at the
+    hash level compares block means against their median, so it is computed
+    directly on the region without resizing it.
+    """
+    means = block_means(pixels, hash_size)
+    return imagehash.ImageHash(means > numpy.median(means))
+
+
 def calc_scores(source_image):
+    image = load_grayscale(source_image)
+    pixels = numpy.asarray(image)
+    min_side = HASH_SIZE * MIN_BLOCK_SIZE
     scores = []
     for item in ALG:
         if item[0] == 'crop':
             v, h, fit_image = item[1:]
             name = '%s_%s_%s_%s' % item
-            var_img = prepare_image(
-                source_image,
+            box = crop_box(
+                image.size,
                 crop_width_perc=v,
                 crop_height_perc=h,
                 fit_image=fit_image
             )
-
-            # val = imagehash.phash(var_img, hash_size=HASH_SIZE, highfreq_factor=HASH_SIZE)
-            val = imagehash.whash(var_img, hash_size=HASH_SIZE)
-            scores.append((name, val))
+            left, top, right, bottom = (int(round(edge)) for edge in box)
+            if right - left < min_side or bottom - top < min_side:
+                # too few pixels per block, resample the region the way RESHAPE resize does
+                region = numpy.asarray(image.resize((min_side, min_side), Image.ANTIALIAS, box=box))
+            else:
+                region = pixels[top:bottom, left:right]
+            scores.append((name, wavelet_hash(region)))
     return scores
 
 
@@ -159,13 +271,117 @@ def get_diff_vector(score1, score2):
     return result_vec
 
 
+MODEL_VERSION = 1
+
+CASCADE_PRECISION = 0.999
+
+
+class ModelMismatch(Exception):
+    pass
+
+
+def alg_signature():
+    return hashlib.sha1(repr((HASH_SIZE, RESHAPE, ALG)).encode()).hexdigest()
+
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DuplicateCascade(namedtuple('DuplicateCascade', 'accept, reject')):
+    """Hamming distance bounds deciding clear cases before the classifier.
+
+    A pair is a duplicate if all its variant distances are within `accept`
+    and is not one if all of them are at least `reject`.
+    """
+    __slots__ = ()
+
+    def split(self, distances):
+        """Masks of accepted, rejected and ambiguous rows of `distances`."""
+        accepted = distances.max(axis=1) <= self.accept
+        rejected = distances.min(axis=1) >= self.reject
+        return accepted, rejected, ~(accepted | rejected)
+
+    def __str__(self):
+        accept = 'off' if self.accept < 0 else 'within %d bits' % self.accept
+        reject = 'off' if self.reject == float('inf') else 'from %d bits' % self.reject
+        return 'accept %s, reject %s' % (accept, reject)
+
+
+DuplicateCascade.DISABLED = DuplicateCascade(accept=-1, reject=float('inf'))
+
+
+def widest_bound(values, correct, precision):
+    """Largest bound keeping the share of `correct` among `values` within it at `precision`, None if there is none."""
+    order = numpy.argsort(values, kind='mergesort')
+    values, correct = values[order], correct[order]
+    shares = numpy.cumsum(correct) / numpy.arange(1, len(values) + 1)
+    # only the last of equal values covers all pairs within the bound
+    ends = numpy.append(values[1:] != values[:-1], True)
+
+    # the share may dip below precision and recover further on
+    passing = values[ends][shares[ends] >= precision]
+    return int(passing[-1]) if len(passing) else None
+
+
+def fit_cascade(training_sample, precision=CASCADE_PRECISION):
+    """Widest cascade bounds whose decisions on `training_sample` are right at `precision`."""
+    df = pd.read_csv(training_sample)
+    distances = df[list(FEATURES)].values
+    is_dup = df['d'].astype('bool').values
+
+    accept = widest_bound(distances.max(axis=1), is_dup, precision)
+    reject = widest_bound(-distances.min(axis=1), ~is_dup, precision)
+    return DuplicateCascade(
+        accept=DuplicateCascade.DISABLED.accept if accept is None else accept,
+        reject=DuplicateCascade.DISABLED.reject if reject is None else -reject,
+    )
+
+
+def save_model(model, path, training_sample, cascade=DuplicateCascade.DISABLED):
+    artifact = {
+        'version': MODEL_VERSION,
+        'model': model,
+        'cascade': tuple(cascade),
+        'features': FEATURES,
+        'hash_size': HASH_SIZE,
+        'alg': alg_signature(),
+        'checksum': file_checksum(training_sample),
+        'created_at': int(time.time()),
+    }
+    with open(path, 'wb') as fp:
+        pickle.dump(artifact, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    return artifact
+
+
+def load_model(path):
+    """Loads model artifact and checks it was trained for the current hashing setup."""
+    with open(path, 'rb') as fp:
+        artifact = pickle.load(fp)
+
+    expected = {
+        'version': MODEL_VERSION,
+        'features': FEATURES,
+        'hash_size': HASH_SIZE,
+        'alg': alg_signature(),
+    }
+    for key, value in expected.items():
+        if artifact.get(key) != value:
+            raise ModelMismatch("Model %s '%s' does not match current '%s'" % (key, artifact.get(key), value))
+    return artifact
+
+
 def fit_model(training_sample):
     df = pd.read_csv(training_sample)
     # convert values to bool
     df['d'] = df['d'].astype('bool')
     l_model = GradientBoostingClassifier()
     l_model = l_model.fit(
-        df[df.columns.difference(['d'])],
+        df[list(FEATURES)],
         df['d']
     )
     return l_model
@@ -0,0 +1,141 @@
+import asyncio
+import datetime
+import os
+
+import numpy
+import pytest
+import trafaret as t
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+from benchmarks.memory_db import MemoryCollection, MemoryDatabase
+from talkbot.entities import Config, ImageFinger
+from talkbot.hamming import pack_hashes
+from talkbot.main import create_ssl_context
+from talkbot.utils import FEATURES, HASH_SIZE
+
+
+def load_config(**options):
+    here = os.path.abspath(__file__)
+    return Config.load_config(dict({'sslchain': here, 'sslprivkey': here, 'sample_df': here}, **options))
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class UnauthorizedCollection(MemoryCollection):
+    """Refuses to create the retention index as for a user without the privilege."""
+
+    async def create_indexes(self, indexes):
+        if any(index.document['name'] == ImageFinger.RETENTION_INDEX for index in indexes):
+            raise OperationFailure("not authorized", code=13)
+        return await super().create_indexes(indexes)
+
+
+def test_config_fields_cover_defaults():
+    config = load_config()
+
+    assert set(Config.default) <= set(Config._fields)
+    assert config.reaction_threshold == Config.default['reaction_threshold']
+
+
+def test_ssl_files_are_required_by_webhook_only():
+    config = Config.load_config({})
+
+    assert config.sslchain == config.sslprivkey == ''
+    with pytest.raises(t.DataError) as error:
+        create_ssl_context(config)
+    assert set(error.value.as_dict()) == {'sslchain', 'sslprivkey'}
+
+
+def test_retention_is_validated_in_days():
+    assert load_config(fingerprint_retention=0).fingerprint_retention == 0
+    assert load_config(fingerprint_retention=30).fingerprint_retention == 30
+    with pytest.raises(t.DataError):
+        load_config(fingerprint_retention=3)
+
+
+def test_retention_index_expires_after_days():
+    db = MemoryDatabase()
+    names = run(ImageFinger.ensure_indexes(config=load_config(fingerprint_retention=30), db=db))
+
+    assert ImageFinger.RETENTION_INDEX in names
+    assert db[ImageFinger.collection].indexes[ImageFinger.RETENTION_INDEX]['expireAfterSeconds'] == 30 * 24 * 60 * 60
+
+
+def test_changed_retention_modifies_index():
+    db = MemoryDatabase()
+    run(ImageFinger.ensure_indexes(config=load_config(fingerprint_retention=7), db=db))
+    run(ImageFinger.ensure_indexes(config=load_config(fingerprint_retention=30), db=db))
+
+    assert db.commands == [('collMod', ImageFinger.collection, {
+        'index': {'name': ImageFinger.RETENTION_INDEX, 'expireAfterSeconds': 30 * 24 * 60 * 60},
+    })]
+
+    db = MemoryDatabase({ImageFinger.collection: UnauthorizedCollection()})
+    with pytest.raises(OperationFailure):
+        run(ImageFinger.ensure_indexes(config=load_config(fingerprint_retention=30), db=db))
+    assert not db.commands
+
+
+def test_disabled_retention_drops_index():
+    db = MemoryDatabase()
+    run(ImageFinger.ensure_indexes(config=load_config(fingerprint_retention=30), db=db))
+    # fingerprints are kept forever unless retention is enabled
+    run(ImageFinger.ensure_indexes(config=load_config(), db=db))
+
+    assert ImageFinger.RETENTION_INDEX not in run(db[ImageFinger.collection].index_information())
+
+
+def test_compact_strips_messages_and_trims_chats():
+    ids = [ObjectId() for _ in range(5)]
+    legacy = {'_id': ids[0], 'chat_id': 1, 'message': {'message_id': 7, 'date': 0, 'text': "long"}}
+    slim = [{'_id': _id, 'chat_id': 1, 'message_id': idx} for idx, _id in enumerate(ids[1:4], 8)]
+    other = {'_id': ids[4], 'chat_id': 2, 'message_id': 1}
+    db = MemoryDatabase()
+    collection = db[ImageFinger.collection]
+    collection.insert_many_documents([legacy] + slim + [other])
+
+    compacted, trimmed = run(ImageFinger.compact(batch_size=1, config=load_config(fingerprints_per_chat=2), db=db))
+
+    assert (compacted, trimmed) == (1, 2)
+    assert collection.bulk_requests == [UpdateOne({'_id': ids[0]}, {
+        '$set': {'message_id': 7, 'posted_at': datetime.datetime(1970, 1, 1)},
+        '$unset': {'message': ''},
+    })]
+    assert [document['_id'] for document in collection.documents] == ids[2:]
+
+    # chats are not trimmed unless a cap is configured
+    db = MemoryDatabase()
+    db[ImageFinger.collection].insert_many_documents([dict(document) for document in slim])
+    assert run(ImageFinger.compact(config=load_config(), db=db)) == (0, 0)
+    assert len(db[ImageFinger.collection].documents) == 3
+
+
+def test_migrate_vectors_packs_legacy_documents():
+    random = numpy.random.RandomState(0)
+    hashes = dict((name, random.rand(HASH_SIZE, HASH_SIZE) > 0.5) for name in FEATURES)
+    packed = pack_hashes(hashes, FEATURES)
+    db = MemoryDatabase()
+    db[ImageFinger.collection].insert_many_documents([
+        {'_id': 1, 'chat_id': 1, 'file_id': 'a', 'vectors': [[name, bits.tolist()] for name, bits in hashes.items()]},
+        {'_id': 2, 'chat_id': 1, 'file_id': 'b', 'vectors': ImageFinger.encode_vectors(packed), 'version': 2},
+    ])
+
+    assert run(ImageFinger.migrate_vectors(FEATURES, db=db)) == 1
+
+    encoded = ImageFinger.encode_vectors(packed)
+    assert db[ImageFinger.collection].bulk_requests == [UpdateOne(
+        {'_id': 1, 'version': {'$exists': False}},
+        {'$set': {'vectors': encoded, 'version': ImageFinger.VERSION}},
+    )]
+    decoded = ImageFinger.decode_vectors(bytes(encoded), ImageFinger.VERSION, FEATURES)
+    assert numpy.array_equal(decoded, packed)
+    assert numpy.array_equal(numpy.unpackbits(decoded[0]).reshape(HASH_SIZE, HASH_SIZE), hashes[FEATURES[0]])
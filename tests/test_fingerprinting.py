@@ -0,0 +1,98 @@
+import asyncio
+import os
+import signal
+
+from concurrent.futures.process import BrokenProcessPool
+
+import inject
+import numpy
+import pytest
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from benchmarks.memory_db import MemoryDatabase
+from talkbot.entities import FileFingerprint
+from talkbot.fingerprinting import (FingerprintCache, FingerprintQueueFull, FingerprintService, cache_lookups,
+                                    fingerprint, pool_restarts)
+from talkbot.loadtest import make_photo
+from talkbot.utils import FEATURES
+
+
+def test_service_rejects_images_over_capacity():
+    loop = asyncio.new_event_loop()
+    service = FingerprintService(1, 1, loop=loop)
+    service.start()
+    data = make_photo(400, 300)
+
+    async def run():
+        accepted = [loop.create_task(service.fingerprint(data)) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert service.full()
+        with pytest.raises(FingerprintQueueFull):
+            await service.fingerprint(data)
+        return await asyncio.gather(*accepted)
+
+    try:
+        results = loop.run_until_complete(run())
+        assert not service.pending
+        for packed in results:
+            assert numpy.array_equal(packed, fingerprint(data))
+    finally:
+        loop.run_until_complete(service.shutdown())
+        loop.close()
+
+
+def test_service_replaces_broken_pool():
+    loop = asyncio.new_event_loop()
+    service = FingerprintService(2, 0, loop=loop)
+    service.start()
+    data = make_photo(400, 300)
+    restarts = pool_restarts.values.get((), 0)
+
+    try:
+        # workers are forked by start, not by the first image
+        processes = list(service.executor._processes.values())
+        assert len(processes) == 2
+        os.kill(processes[0].pid, signal.SIGKILL)
+        processes[0].join()
+
+        with pytest.raises(BrokenProcessPool):
+            loop.run_until_complete(service.fingerprint(data))
+        assert pool_restarts.values[()] == restarts + 1
+        assert not service.pending
+
+        packed = loop.run_until_complete(service.fingerprint(data))
+        assert numpy.array_equal(packed, fingerprint(data))
+    finally:
+        loop.run_until_complete(service.shutdown())
+        loop.close()
+
+
+def test_cache_evicts_least_recently_used():
+    loop = asyncio.new_event_loop()
+    db = MemoryDatabase()
+    inject.clear_and_configure(lambda binder: binder.bind(AsyncIOMotorDatabase, db))
+    cache = FingerprintCache(FileFingerprint, FEATURES, 2)
+    packed = {name: fingerprint(make_photo(400, 300, seed)) for seed, name in enumerate('abc')}
+    lookups = {result: cache_lookups.values.get((result,), 0) for result in ('memory', 'storage', 'miss')}
+
+    try:
+        loop.run_until_complete(cache.put('a', packed['a']))
+        loop.run_until_complete(cache.put('b', packed['b']))
+        # a hit makes `a` the most recent, so `b` goes first
+        assert numpy.array_equal(loop.run_until_complete(cache.get('a')), packed['a'])
+        loop.run_until_complete(cache.put('c', packed['c']))
+        assert list(cache.items) == ['a', 'c']
+        assert cache_lookups.values[('memory',)] == lookups['memory'] + 1
+
+        # evicted fingerprints are still read from the collection
+        assert numpy.array_equal(loop.run_until_complete(cache.get('b')), packed['b'])
+        assert cache_lookups.values[('storage',)] == lookups['storage'] + 1
+        assert list(cache.items) == ['c', 'b']
+
+        assert loop.run_until_complete(cache.get('unknown')) is None
+        assert cache_lookups.values[('miss',)] == lookups['miss'] + 1
+        assert len(db[FileFingerprint.collection].documents) == 3
+    finally:
+        inject.clear()
+        loop.close()
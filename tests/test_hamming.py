@@ -0,0 +1,99 @@
+import asyncio
+import tracemalloc
+
+import numpy
+
+from talkbot.hamming import ChatFingerprints, FingerprintIndex, IndexedFinger, MultiIndex, hamming_distances, \
+    pack_hashes
+
+
+def test_multi_index_matches_brute_force():
+    rnd = numpy.random.RandomState(42)
+    codes = rnd.randint(0, 256, (400, 2, 32)).astype(numpy.uint8)
+    query = codes[7].copy()
+    query[0, :3] ^= 0b1001
+    # close in the second variant only, added after the first merge
+    codes[320, 1] = query[1]
+    codes[320, 1, 0] ^= 0b11
+    radius = 40
+
+    index = MultiIndex(256, radius, variants=2)
+    # merged, left in the tail, merged into existing keys
+    for size, expected in ((300, [7]), (350, [7, 320]), (400, [7, 320])):
+        for code in codes[len(index):size]:
+            index.add(code)
+        brute_force = numpy.flatnonzero((hamming_distances(query, codes[:size]) <= radius).any(axis=1))
+        assert index.search(query).tolist() == brute_force.tolist() == expected
+
+
+def test_chat_nbytes_is_memory_taken():
+    packed = numpy.random.RandomState(0).randint(0, 256, (3000, 8, 32)).astype(numpy.uint8)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        chat = ChatFingerprints(radius=24)
+        for message_id, matrix in enumerate(packed):
+            chat.add(IndexedFinger(message_id=message_id, file_id='file-%d' % message_id, packed=matrix))
+        chat.candidates(packed[0])
+        taken = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    assert abs(taken - chat.nbytes) < 0.05 * taken
+
+
+def test_chat_candidates_by_any_variant():
+    rnd = numpy.random.RandomState(0)
+    original = rnd.rand(16, 16) > 0.5
+    unrelated = rnd.rand(16, 16) > 0.5
+    noisy = original.copy()
+    noisy[0, :5] = ~noisy[0, :5]
+    names = ('a', 'b')
+
+    chat = ChatFingerprints(radius=10)
+    chat.add(IndexedFinger(message_id=10, file_id='x', packed=pack_hashes({'a': original, 'b': unrelated}, names)))
+    chat.add(IndexedFinger(message_id=20, file_id='y', packed=pack_hashes({'a': unrelated, 'b': unrelated}, names)))
+
+    query = pack_hashes({'a': noisy, 'b': original}, names)
+    found = chat.candidates(query)
+    assert [finger.message_id for finger in found] == [10]
+
+    distances = hamming_distances(query, numpy.stack([finger.packed for finger in found]))
+    assert distances.tolist() == [[5, numpy.count_nonzero(original != unrelated)]]
+
+
+def test_index_evicts_least_recently_used_chats():
+    index = FingerprintIndex(None, ('a',), radius=4, budget=1)
+    for chat_id in (1, 2, 3):
+        chat = ChatFingerprints(radius=4)
+        chat.add(IndexedFinger(message_id=chat_id, file_id=str(chat_id), packed=numpy.zeros((1, 32), numpy.uint8)))
+        index.chats[chat_id] = chat
+        index.nbytes += chat.nbytes
+        index._evict()
+
+    assert list(index.chats) == [3]
+    assert index.nbytes == index.chats[3].nbytes
+    assert index.chats[3].find_file(['0', '3']).message_id == 3
+
+
+def test_index_trims_chats_over_cap():
+    class Entity:
+        trimmed = None
+
+        async def trim_chat(self, chat_id, cap):
+            self.trimmed = (chat_id, cap)
+            return 2
+
+    entity = Entity()
+    index = FingerprintIndex(entity, ('a',), radius=4, cap=10)
+    chat = ChatFingerprints(radius=4)
+    packed = numpy.zeros((1, 32), numpy.uint8)
+    for message_id in range(12):
+        chat.add(IndexedFinger(message_id=message_id, file_id=str(message_id), packed=packed))
+    index.chats[1] = chat
+    index.nbytes = chat.nbytes
+
+    assert index.needs_trim(1)
+    assert asyncio.new_event_loop().run_until_complete(index.trim(1)) == 2
+    assert entity.trimmed == (1, 10)
+    assert not index.chats and index.nbytes == 0
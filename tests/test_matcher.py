@@ -0,0 +1,91 @@
+import asyncio
+
+from bson import ObjectId
+
+from benchmarks.memory_db import MemoryDatabase
+from talkbot.entities import Reaction
+from talkbot.matcher import PatternAutomaton, ReactionMatcher
+
+
+def make_reaction(id, patterns, text):
+    return Reaction(id=id, patterns=patterns, image_url='', image_id='', text=text,
+                    created_at=0, created_by={}, last_used=0)
+
+
+def test_automaton_finds_overlapping_patterns():
+    automaton = PatternAutomaton(['he', 'she', 'his', 'hers'])
+
+    assert automaton.search('ushers') == {'he', 'she', 'hers'}
+    assert automaton.search('nothing') == set()
+
+
+def test_automaton_rebuilds_on_add():
+    automaton = PatternAutomaton(['баян'])
+    assert automaton.search('опять баян') == {'баян'}
+
+    automaton.add('опят')
+    assert automaton.search('опять баян') == {'баян', 'опят'}
+
+
+def test_matcher_prefers_latest_reaction():
+    matcher = ReactionMatcher()
+    matcher.add(make_reaction('1', ['hello'], 'first'))
+    matcher.add(make_reaction('2', ['hell', 'world'], 'second'))
+
+    assert matcher.match('Hello there').text == 'second'
+    assert matcher.match('nope') is None
+
+
+def make_document(patterns, text):
+    return {'patterns': patterns, 'image_url': '', 'image_id': '', 'text': text,
+            'created_at': 0, 'created_by': {'id': 1, 'first_name': "test"}}
+
+
+def test_matcher_loads_only_changes():
+    loop = asyncio.new_event_loop()
+    db = MemoryDatabase()
+    collection = db[Reaction.collection]
+    collection.insert_many_documents([make_document(['hello'], 'first'), make_document(['world'], 'second')])
+    matcher = ReactionMatcher(loop=loop)
+
+    try:
+        loop.run_until_complete(matcher.load(db=db))
+        assert matcher.match('hello world').text == 'second'
+        reactions, automaton = list(matcher.reactions), matcher.automaton
+
+        # nothing changed
+        loop.run_until_complete(matcher.load(db=db))
+        assert matcher.reactions == reactions and matcher.automaton is automaton
+
+        # appended by another process, the compiled automaton is kept
+        collection.insert_many_documents([make_document(['hell'], 'third')])
+        loop.run_until_complete(matcher.load(db=db))
+        assert matcher.reactions[:2] == reactions and matcher.automaton is automaton
+        assert matcher.match('hello').text == 'third'
+
+        # removed by another process
+        loop.run_until_complete(collection.delete_many({'text': 'first'}))
+        loop.run_until_complete(matcher.load(db=db))
+        assert len(matcher) == 2 and matcher.automaton is not automaton
+        assert matcher.match('world').text == 'second'
+    finally:
+        loop.close()
+
+
+def test_matcher_compiles_recent_patterns_in_background():
+    loop = asyncio.new_event_loop()
+    matcher = ReactionMatcher(recent_limit=2, loop=loop)
+
+    try:
+        for idx, pattern in enumerate(['one', 'two']):
+            matcher.add(make_reaction(ObjectId(), [pattern], str(idx)))
+        assert matcher._compiling is None and not matcher.compiled
+
+        matcher.add(make_reaction(ObjectId(), ['three'], '2'))
+        # matched by the recent automaton until the new one is compiled
+        assert matcher.match('three').text == '2'
+        loop.run_until_complete(matcher._compiling)
+        assert matcher.compiled == 3 and not len(matcher.recent)
+        assert matcher.match('one, two, three').text == '2'
+    finally:
+        loop.close()
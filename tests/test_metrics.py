@@ -0,0 +1,30 @@
+from talkbot.metrics import REGISTRY, Counter, Gauge, Histogram, render
+
+
+def test_render():
+    registry = []
+    counter = Counter('test_total', "Test counter", ['kind'], registry=registry)
+    Gauge('test_depth', "Test gauge", function=lambda: 3, registry=registry)
+    histogram = Histogram('test_seconds', "Test histogram", buckets=(0.1, 1), registry=registry)
+    assert not any(metric.name.startswith('test_') for metric in REGISTRY)
+
+    counter.inc(kind='a"b')
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert render(registry).splitlines() == [
+        '# HELP test_total Test counter',
+        '# TYPE test_total counter',
+        'test_total{kind="a\\"b"} 1',
+        '# HELP test_depth Test gauge',
+        '# TYPE test_depth gauge',
+        'test_depth 3',
+        '# HELP test_seconds Test histogram',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1.0"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        'test_seconds_sum 5.55',
+        'test_seconds_count 3',
+    ]
@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+from talkbot.outbound import OutboundDispatcher
+from talkbot.utils import ApiError
+
+
+class FakeApi:
+    """Fails calls with the prepared errors by text, records the rest."""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.attempts = []
+        self.delivered = []
+
+    async def send(self, method, payload):
+        self.attempts.append((payload['text'], time.monotonic()))
+        errors = self.errors.get(payload['text'])
+        if errors:
+            raise errors.pop(0)
+        self.delivered.append(payload['text'])
+
+
+def deliver(api, messages, **options):
+    loop = asyncio.new_event_loop()
+    options = dict({'chat_rate': 1000, 'group_rate': 1000, 'backoff': 0.001}, **options)
+    dispatcher = OutboundDispatcher(api.send, loop=loop, **options)
+    started = time.monotonic()
+    try:
+        for chat_id, text in messages:
+            dispatcher.submit('sendMessage', {'chat_id': chat_id, 'text': text})
+        loop.run_until_complete(dispatcher.stop(5))
+    finally:
+        loop.close()
+    return started
+
+
+def test_group_reply_goes_out_in_a_burst():
+    api = FakeApi()
+    started = deliver(api, [(-1, "Баян"), (-1, "Пруф"), (-1, "flood")], group_rate=2, chat_burst=2)
+
+    assert api.delivered == ["Баян", "Пруф", "flood"]
+    assert api.attempts[1][1] - started < 0.2
+    # the call over the burst waits for the group rate
+    assert api.attempts[2][1] - started >= 0.4
+
+
+def test_retry_after_is_respected():
+    api = FakeApi({'one': [ApiError(429, "Too Many Requests", {'retry_after': 0.2})]})
+    deliver(api, [(1, 'one')])
+
+    assert api.delivered == ['one']
+    assert api.attempts[1][1] - api.attempts[0][1] >= 0.2
+
+
+def test_server_errors_are_retried_with_backoff():
+    api = FakeApi({'one': [ApiError(502, "Bad Gateway"), ApiError(500, "Internal Server Error")]})
+    deliver(api, [(1, 'one')])
+
+    assert [text for text, _ in api.attempts] == ['one'] * 3
+    assert api.delivered == ['one']
+
+
+def test_permanent_errors_are_not_retried():
+    api = FakeApi({'one': [ApiError(400, "Bad Request: chat not found")] * 5})
+    deliver(api, [(1, 'one'), (1, 'two')])
+
+    assert [text for text, _ in api.attempts] == ['one', 'two']
+    assert api.delivered == ['two']
+
+
+def test_gives_up_after_retries():
+    api = FakeApi({'one': [ApiError(502, "Bad Gateway") for _ in range(5)]})
+    deliver(api, [(1, 'one'), (1, 'two')], retries=3)
+
+    assert [text for text, _ in api.attempts] == ['one'] * 3 + ['two']
+    assert api.delivered == ['two']
+
+
+def test_chat_order_is_kept_across_retries():
+    api = FakeApi({'a1': [ApiError(502, "Bad Gateway")]})
+    deliver(api, [(1, 'a1'), (2, 'b1'), (1, 'a2'), (2, 'b2'), (1, 'a3')])
+
+    assert [text for text in api.delivered if text.startswith('a')] == ['a1', 'a2', 'a3']
+    assert [text for text in api.delivered if text.startswith('b')] == ['b1', 'b2']
+    # the other chat isn't held up by the retry
+    assert api.delivered.index('b2') < api.delivered.index('a1')
@@ -0,0 +1,37 @@
+import asyncio
+import glob
+import pstats
+
+from talkbot.fingerprinting import FingerprintService
+from talkbot.loadtest import make_photo
+from talkbot.profiling import Profiler
+
+
+class Target:
+
+    async def handler(self, update):
+        pass
+
+
+def test_fingerprint_workers_are_profiled(tmpdir):
+    loop = asyncio.new_event_loop()
+    service = FingerprintService(1, 0, loop=loop)
+    service.start()
+    profiler = Profiler(Target(), str(tmpdir), fingerprinter=service, loop=loop)
+
+    try:
+        loop.run_until_complete(service.fingerprint(make_photo(400, 300)))
+        profiler.start()
+        loop.run_until_complete(service.fingerprint(make_photo(400, 300)))
+        path = profiler.stop()
+        loop.run_until_complete(service.fingerprint(make_photo(400, 300)))
+    finally:
+        loop.run_until_complete(service.shutdown())
+        loop.close()
+
+    workers = glob.glob(str(tmpdir.join('*-worker-*.pstats')))
+    assert len(workers) == 1 and workers[0].startswith(path[:-len('.pstats')])
+    functions = pstats.Stats(workers[0]).stats
+    calls = [stats[0] for (_, _, name), stats in functions.items() if name == 'calc_scores']
+    # only the image hashed while profiling
+    assert calls == [1]
@@ -0,0 +1,59 @@
+import asyncio
+
+import inject
+
+from benchmarks.run import FakeBot, configure
+from talkbot.entities import ImageFinger
+from talkbot.fingerprinting import FingerprintCache, fingerprint
+from talkbot.loadtest import make_photo
+from talkbot.reactor import MessageReactor
+
+
+class RecordingBot(FakeBot):
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.calls = []
+
+    async def get_file(self, file_id):
+        self.calls.append(('get_file', file_id))
+        return await super().get_file(file_id)
+
+    async def download_file(self, path):
+        self.calls.append(('download_file', path))
+        return await super().download_file(path)
+
+
+def make_message(message_id, file_id, file_unique_id):
+    return {
+        'message_id': message_id,
+        'chat': {'id': 1},
+        'date': 0,
+        'photo': [{'file_id': file_id, 'file_unique_id': file_unique_id, 'width': 800, 'height': 600}],
+    }
+
+
+def test_cached_fingerprint_skips_download():
+    loop = asyncio.new_event_loop()
+    db, fingerprints, fingerprinter = configure(loop)
+    data = make_photo(400, 300)
+    bot = RecordingBot(data)
+
+    async def check(message):
+        await MessageReactor(message, bot).check_repetitions(message)
+
+    try:
+        # the same file posted in another chat
+        loop.run_until_complete(inject.instance(FingerprintCache).put('unique', fingerprint(data)))
+        loop.run_until_complete(check(make_message(1, 'forwarded', 'unique')))
+        assert bot.calls == []
+        assert db[ImageFinger.collection].documents[0]['file_id'] == 'forwarded'
+        assert len(fingerprints.chats[1]) == 1
+
+        loop.run_until_complete(check(make_message(2, 'other', 'other-unique')))
+        assert bot.calls == [('get_file', 'other'), ('download_file', 'photos/other.jpg')]
+        assert 'other-unique' in inject.instance(FingerprintCache).items
+    finally:
+        loop.run_until_complete(fingerprinter.shutdown())
+        inject.clear()
+        loop.close()
@@ -0,0 +1,41 @@
+import numpy
+import pytest
+
+from talkbot import trainset
+from talkbot.fingerprinting import fingerprint
+from talkbot.loadtest import make_photo
+
+
+class InterruptedPool:
+    """Hashes in this process, interrupted after `limit` images."""
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.hashed = []
+
+    def imap_unordered(self, func, items, chunksize=1):
+        for item in items:
+            if len(self.hashed) == self.limit:
+                raise KeyboardInterrupt
+            self.hashed.append(item)
+            yield func(item)
+
+
+def test_interrupted_hashing_is_resumed(tmpdir, monkeypatch):
+    monkeypatch.setattr(trainset, 'TRAINDIR', str(tmpdir))
+    names = []
+    for seed in range(5):
+        names.append('%d_0.jpg' % seed)
+        tmpdir.join(names[-1]).write_binary(make_photo(400, 300, seed))
+    cache = str(tmpdir.join('hashes.npz'))
+
+    with pytest.raises(KeyboardInterrupt):
+        trainset.load_hashes(names, cache, InterruptedPool(limit=3), save_every=2)
+    with numpy.load(cache) as saved:
+        assert len(saved['stamps']) == 2
+
+    pool = InterruptedPool()
+    packed = trainset.load_hashes(names, cache, pool, save_every=2)
+    assert pool.hashed == names[2:]
+    for name, matrix in zip(names, packed):
+        assert numpy.array_equal(matrix, fingerprint(tmpdir.join(name).read_binary()))
@@ -0,0 +1,113 @@
+import asyncio
+import json
+
+import pytest
+
+from talkbot.updates import QueueFull, UpdatePoller, UpdateQueue, UpdateRecorder, updates_dropped
+
+
+def test_recorder_scrubs_secrets(tmpdir):
+    path = str(tmpdir.join('updates.jsonl'))
+    recorder = UpdateRecorder(path, secrets=['123:token'])
+    recorder.record({'update_id': 1, 'message': {'text': "see https://api.telegram.org/bot123:token/getMe",
+                                                 'entities': [{'url': "123:token"}]}})
+    recorder.close()
+
+    with open(path) as recording:
+        line = json.loads(recording.read())
+    assert line['update']['message']['text'] == "see https://api.telegram.org/bot<scrubbed>/getMe"
+    assert line['update']['message']['entities'] == [{'url': "<scrubbed>"}]
+    assert line['offset'] >= 0
+
+
+class FakeBot:
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.update_offset = 0
+        self.requests = []
+
+    async def get_updates(self, limit=100, timeout=30):
+        self.requests.append((self.update_offset, limit, timeout))
+        return self.batches.pop(0) if self.batches else []
+
+
+def test_poller_confirms_last_batch_on_stop():
+    loop = asyncio.new_event_loop()
+    bot = FakeBot([[{'update_id': 1}, {'update_id': 2}]])
+    handled = []
+
+    async def handler(update):
+        handled.append(update['update_id'])
+        if update['update_id'] == 2:
+            poller.stop()
+
+    poller = UpdatePoller(bot, handler, limit=10, timeout=5, loop=loop)
+    try:
+        loop.run_until_complete(poller.run())
+    finally:
+        loop.close()
+
+    assert handled == [1, 2]
+    assert bot.update_offset == 3
+    # the batch is not delivered again after a restart
+    assert bot.requests == [(0, 10, 5), (3, 1, 0)]
+
+
+def make_update(update_id, chat_id):
+    return {'update_id': update_id, 'message': {'chat': {'id': chat_id}}}
+
+
+def test_queue_keeps_chat_order_without_blocking_other_chats():
+    loop = asyncio.new_event_loop()
+    release = asyncio.Event(loop=loop)
+    handled = []
+
+    async def handler(update):
+        if update['update_id'] == 1:
+            await release.wait()
+        handled.append(update['update_id'])
+        if len(handled) == 4:
+            release.set()
+
+    queue = UpdateQueue(handler, 2, 10, loop=loop)
+    queue.start()
+    # chat 1 is stuck on its first update, chats 2 and 3 share the other worker
+    for update_id, chat_id in [(1, 1), (2, 1), (3, 2), (4, 3), (5, 2), (6, 3)]:
+        queue.put(make_update(update_id, chat_id))
+
+    try:
+        loop.run_until_complete(asyncio.wait_for(queue.join(), 1, loop=loop))
+        loop.run_until_complete(queue.stop(1))
+    finally:
+        loop.close()
+
+    assert handled[:4] == [3, 4, 5, 6]
+    assert handled[4:] == [1, 2]
+    assert not queue.qsize() and not queue.queues
+
+
+@pytest.mark.parametrize('overflow, pending', [
+    ('reject', [1, 2]),
+    ('drop_new', [1, 2]),
+    ('drop_oldest', [2, 3]),
+])
+def test_queue_overflow(overflow, pending):
+    loop = asyncio.new_event_loop()
+    queue = UpdateQueue(None, 1, 2, overflow=overflow, loop=loop)
+    dropped = updates_dropped.values.get((overflow,), 0)
+
+    try:
+        queue.put(make_update(1, 1))
+        queue.put(make_update(2, 1))
+        if overflow == 'reject':
+            with pytest.raises(QueueFull):
+                queue.put(make_update(3, 2))
+        else:
+            queue.put(make_update(3, 2))
+    finally:
+        loop.close()
+
+    assert queue.qsize() == 2
+    assert [update['update_id'] for chat in queue.queues.values() for _, update in chat] == pending
+    assert updates_dropped.values[(overflow,)] == dropped + 1
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from pymongo import UpdateOne
+
+from benchmarks.memory_db import MemoryCollection, MemoryDatabase
+from talkbot.usage import UsageLedger
+
+
+class FlakyCollection(MemoryCollection):
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    async def bulk_write(self, requests, ordered=True):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("connection lost")
+        return await super().bulk_write(requests, ordered)
+
+
+def test_get_prefers_later_timestamp():
+    ledger = UsageLedger('reactions')
+    ledger.touch('a', 100)
+
+    assert ledger.get('a', 50) == 100
+    assert ledger.get('a', 200) == 200
+    assert ledger.get('b', 30) == 30
+    assert ledger.get('b') == 0
+
+
+def test_flush_keeps_pending_after_failure():
+    loop = asyncio.new_event_loop()
+    db = MemoryDatabase(reactions=FlakyCollection(failures=1))
+    ledger = UsageLedger('reactions')
+    ledger.touch('a', 100)
+    ledger.touch('b', 100)
+
+    try:
+        with pytest.raises(ConnectionError):
+            loop.run_until_complete(ledger.flush(db=db))
+        # touched again before the retry
+        ledger.touch('a', 150)
+        assert ledger.pending == {'a': 150, 'b': 100}
+
+        assert loop.run_until_complete(ledger.flush(db=db)) == 2
+        assert loop.run_until_complete(ledger.flush(db=db)) == 0
+    finally:
+        loop.close()
+
+    assert not ledger.pending
+    assert db['reactions'].bulk_requests == [
+        UpdateOne({'_id': 'a'}, {'$max': {'last_used': 150}}),
+        UpdateOne({'_id': 'b'}, {'$max': {'last_used': 100}}),
+    ]
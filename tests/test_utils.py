@@ -0,0 +1,147 @@
+import asyncio
+import io
+
+import imagehash
+import numpy
+import pytest
+import trafaret as t
+
+from PIL import Image
+
+from talkbot import utils
+from talkbot.entities import Config
+from talkbot.loadtest import make_photo
+from talkbot.main import load_image_model
+from talkbot.utils import ALG, FEATURES, HASH_SIZE, DuplicateCascade, FileTooLarge, ModelMismatch, calc_scores, \
+    fit_cascade, fit_model, load_model, prepare_image, read_limited, save_model, select_photo_size, widest_bound
+
+# stored fingerprints are compared by a model trained on the previous pipeline. The same photo downscaled
+# by half and saved again as JPEG, as Telegram does with its smaller sizes, already hashes up to 8 bits
+# apart with that pipeline, so differences within it are re-encoding noise the model is used to.
+MAX_DISTANCE = 8
+
+
+def legacy_scores(source_image):
+    scores = []
+    for item in ALG:
+        v, h, fit_image = item[1:]
+        var_img = prepare_image(source_image, crop_width_perc=v, crop_height_perc=h, fit_image=fit_image)
+        scores.append(('%s_%s_%s_%s' % item, imagehash.whash(var_img, hash_size=HASH_SIZE)))
+    return scores
+
+
+@pytest.mark.parametrize('size', [(90, 67), (320, 240), (800, 800), (1280, 960), (720, 1280), (2000, 1500)])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_calc_scores_compatible_with_stored_fingerprints(size, seed):
+    data = make_photo(*size, seed=seed)
+
+    expected = legacy_scores(Image.open(io.BytesIO(data)))
+    scores = calc_scores(Image.open(io.BytesIO(data)))
+
+    assert [name for name, _ in scores] == [name for name, _ in expected]
+    for (name, img_hash), (_, expected_hash) in zip(scores, expected):
+        assert img_hash - expected_hash <= MAX_DISTANCE, name
+
+
+def write_sample(tmpdir):
+    rows = [[2] * len(FEATURES) + [True]] * 5 + [[10] * len(FEATURES) + [True]] + \
+        [[10] * len(FEATURES) + [False]] + [[90] * len(FEATURES) + [False]] * 5
+    sample = tmpdir.join('sample.csv')
+    sample.write('\n'.join(','.join(str(value) for value in row) for row in [list(FEATURES) + ['d']] + rows))
+    return str(sample), rows
+
+
+def test_fit_cascade(tmpdir):
+    sample, rows = write_sample(tmpdir)
+
+    cascade = fit_cascade(sample, precision=0.99)
+    assert cascade == DuplicateCascade(accept=2, reject=90)
+
+    accepted, rejected, ambiguous = cascade.split(numpy.array([row[:-1] for row in rows[4:8]]))
+    assert accepted.tolist() == [True, False, False, False]
+    assert rejected.tolist() == [False, False, False, True]
+    assert ambiguous.tolist() == [False, True, True, False]
+
+
+def test_widest_bound_looks_past_dips():
+    values = numpy.array([1, 2, 3, 3, 4, 5, 6])
+    correct = numpy.array([True, False, True, True, True, True, False])
+
+    # shares at the bounds are 1, .5, .75, .8, .83 and .71
+    assert widest_bound(values, correct, precision=0.8) == 5
+    assert widest_bound(values, correct, precision=1.0) == 1
+    assert widest_bound(values, ~correct, precision=0.9) is None
+    assert str(DuplicateCascade.DISABLED) == 'accept off, reject off'
+
+
+def test_model_artifact_round_trip(tmpdir, monkeypatch):
+    sample, rows = write_sample(tmpdir)
+    path = str(tmpdir.join('model.pkl'))
+    model = fit_model(sample)
+    saved = save_model(model, path, sample, DuplicateCascade(accept=2, reject=90))
+
+    artifact = load_model(path)
+    assert artifact['checksum'] == saved['checksum'] == utils.file_checksum(sample)
+    assert DuplicateCascade(*artifact['cascade']) == DuplicateCascade(accept=2, reject=90)
+    distances = numpy.array([row[:-1] for row in rows])
+    assert artifact['model'].predict(distances).tolist() == model.predict(distances).tolist()
+
+    # trained for another hashing setup
+    monkeypatch.setattr(utils, 'HASH_SIZE', HASH_SIZE * 2)
+    with pytest.raises(ModelMismatch):
+        load_model(path)
+
+
+def test_sample_is_required_without_model(tmpdir):
+    sample, _ = write_sample(tmpdir)
+    config = Config.load_config({'model': str(tmpdir.join('missing.pkl'))})
+
+    with pytest.raises(t.DataError) as error:
+        load_image_model(config)
+    assert set(error.value.as_dict()) == {'sample_df'}
+
+    model, cascade = load_image_model(config._replace(sample_df=sample))
+    assert cascade.accept >= 2
+    assert model.predict(numpy.array([[90] * len(FEATURES)])).tolist() == [False]
+
+
+def test_select_photo_size():
+    sizes = [{'file_id': 'l', 'width': 1280, 'height': 960}, {'file_id': 's', 'width': 90, 'height': 67},
+             {'file_id': 'm', 'width': 320, 'height': 240}, {'file_id': 'x', 'width': 800, 'height': 600}]
+
+    assert select_photo_size(sizes, 240)['file_id'] == 'm'
+    assert select_photo_size(sizes, 320)['file_id'] == 'x'
+    # none is large enough
+    assert select_photo_size(sizes, 2000)['file_id'] == 'l'
+
+
+class ChunkedStream:
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.read = 0
+
+    async def iter_any(self):
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+
+def test_read_limited():
+    loop = asyncio.new_event_loop()
+    try:
+        stream = ChunkedStream([b'x' * 10] * 3)
+        assert loop.run_until_complete(read_limited(stream, 30, length=30)) == b'x' * 30
+
+        stream = ChunkedStream([b'x' * 10] * 3)
+        with pytest.raises(FileTooLarge):
+            loop.run_until_complete(read_limited(stream, 25, length=30))
+        assert stream.read == 0
+
+        # no Content-Length, the download stops at the chunk over the limit
+        stream = ChunkedStream([b'x' * 10] * 5)
+        with pytest.raises(FileTooLarge):
+            loop.run_until_complete(read_limited(stream, 25))
+        assert stream.read == 3
+    finally:
+        loop.close()